@@ -2,9 +2,25 @@
 # Contains a Vigenere cipher, Hill cipher, column transposition, \
 # chain addition, ADFGVX-type array cipher and other permutation ciphers.
 
-from numpy import array
+import argparse
+from array import array
+from collections import OrderedDict, deque
+from itertools import islice
+import json
+from math import gcd
+import mmap
+import numpy as np
+import os
+import re
 from secrets import choice
-from sympy import Matrix
+import socket
+import sys
+from threading import Lock, local
+from time import perf_counter
+import tracemalloc
+import zlib
+# asyncio and concurrent.futures are imported by the functions which use \
+# them, as together they double the time taken to import the cipher
 
 README = "This is a program designed to encrypt a message of up "\
          "to 10,000 characters using a substitution - permutation\n"\
@@ -50,35 +66,236 @@ CODE_LIST = [
 ]
 CODE_LETTER = ["A", "M", "N", "W", "V", "X", "Z"]
 REFERENCE_LEN = len(REFERENCE_LIST)
-HILL_CODE = array([
+HILL_CODE = np.array([
     49, 34, 31, 5, 3, 21, 17, 18,
     13, 8, 19, 44, 17, 28, 34, 28
 ])
 HILL_MATRIX = HILL_CODE.reshape(4, 4)
-HILL_MATRIX_INV = array(Matrix(HILL_MATRIX).inv_mod(REFERENCE_LEN))
+
+
+def inv_mod(matrix, modulus=REFERENCE_LEN):
+    """Finds the inverse of a square matrix modulo the modulus."""
+    # Gauss-Jordan elimination on the matrix joined with the identity \
+    # matrix.  Each pivot must have an inverse modulo the modulus, which \
+    # for a power of a prime such as 49 can always be found when the \
+    # matrix has an inverse.
+    matrix = np.asarray(matrix).tolist()
+    size = len(matrix)
+    rows = [[int(value) % modulus for value in row] +
+            [int(r == c) for c in range(size)] for r, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = next((r for r in range(col, size)
+                      if gcd(rows[r][col], modulus) == 1), None)
+        if pivot is None:
+            raise ValueError(f"The matrix has no inverse modulo {modulus}.")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inverse = pow(rows[col][col], -1, modulus)
+        rows[col] = [value * inverse % modulus for value in rows[col]]
+        for r in range(size):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [(value - factor * pivot_value) % modulus
+                           for value, pivot_value in zip(rows[r], rows[col])]
+    return np.array([row[size:] for row in rows], dtype=int)
+
+
+HILL_MATRIX_INV = inv_mod(HILL_MATRIX)
+# Letter numbers of each code list entry and the code list entry of each \
+# pair of letter numbers, as per the order of the code letters
+SYMBOL_LETTERS = np.array([[CODE_LETTER.index(pair[0]),
+                            CODE_LETTER.index(pair[1])] for pair in CODE_LIST])
+LETTER_SYMBOLS = np.empty((len(CODE_LETTER), len(CODE_LETTER)), dtype=int)
+LETTER_SYMBOLS[SYMBOL_LETTERS[:, 0], SYMBOL_LETTERS[:, 1]] = \
+    np.arange(REFERENCE_LEN)
+
+# Lookup tables so that the characters do not need to be searched for
+REFERENCE_INDEX = {c: n for n, c in enumerate(REFERENCE_LIST)}
+CODE_INDEX = {pair: n for n, pair in enumerate(CODE_LIST)}
+# 256 entry byte tables for bytes.translate, characters which are not in \
+# the list are translated to the invalid number
+_INVALID = 255
+_REFERENCE_ENCODE = bytearray([_INVALID] * 256)
+for _n, _c in enumerate(REFERENCE_LIST):
+    _REFERENCE_ENCODE[ord(_c)] = _n
+_REFERENCE_ENCODE = bytes(_REFERENCE_ENCODE)
+_REFERENCE_DECODE = bytes([ord(_c) for _c in REFERENCE_LIST]).ljust(256, b"?")
+_LETTER_ENCODE = bytearray([_INVALID] * 256)
+for _n, _c in enumerate(CODE_LETTER):
+    _LETTER_ENCODE[ord(_c)] = _n
+_LETTER_ENCODE = bytes(_LETTER_ENCODE)
+_LETTER_DECODE = bytes([ord(_c) for _c in CODE_LETTER]).ljust(256, b"?")
+del _n, _c
+# bytes.translate tables of _substitute, which deletes the characters \
+# which are not in the reference list and changes spaces to ?
+_SUBSTITUTE_TABLE = bytes.maketrans(b" ", b"?")
+_SUBSTITUTE_DELETE = bytes(_n for _n in range(256) if _n != ord(" ")
+                           and chr(_n) not in REFERENCE_INDEX)
+_SUBSTITUTE_DELETE_SPACES = _SUBSTITUTE_DELETE + b" "
+# str.translate table from each reference character to its code list pair
+_CODE_PAIR_TABLE = str.maketrans(dict(zip(REFERENCE_LIST, CODE_LIST)))
+# Lookup arrays for the files, which are substituted as bytes: lower case \
+# letters are converted to upper case and spaces to ?
+_FILE_ENCODE = np.frombuffer(_REFERENCE_ENCODE, dtype=np.uint8).copy()
+_FILE_ENCODE[np.frombuffer(b"abcdefghijklmnopqrstuvwxyz", dtype=np.uint8)] = \
+    _FILE_ENCODE[np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", dtype=np.uint8)]
+_FILE_ENCODE[ord(" ")] = REFERENCE_INDEX["?"]
+_FILE_DECODE = np.frombuffer(_REFERENCE_DECODE.replace(b"?", b" "),
+                             dtype=np.uint8)
+_FILE_REFERENCE = np.frombuffer(_REFERENCE_ENCODE, dtype=np.uint8)
+_FILE_LETTER_ENCODE = np.frombuffer(_LETTER_ENCODE, dtype=np.uint8)
+_FILE_LETTER_DECODE = np.frombuffer(_LETTER_DECODE, dtype=np.uint8)
+
+
+class _LRUCache:
+    """
+    A thread safe least recently used cache with a maximum size.  If a
+    ttl is given, values expire that many seconds after they were last
+    cached or returned by get.  If on_evict is given, it is called with
+    the key and value of every value which is evicted or expires.  If
+    weigh is given, the size is the most total weight of the values
+    rather than the most values.
+    """
+
+    def __init__(self, size, ttl=None, on_evict=None, weigh=None):
+        self._items = OrderedDict()
+        self._lock = Lock()
+        self.size = size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.weigh = weigh
+        self._weight = 0
+
+    def __len__(self):
+        self.evict()
+        return len(self._items)
+
+    def get(self, key):
+        """Returns the cached value or None, marking it as recently used."""
+        with self._lock:
+            evicted = self._evict() if self.ttl is not None else []
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                if self.ttl is not None:
+                    self._items[key] = (item[0], perf_counter() + self.ttl,
+                                        item[2])
+        self._evicted(evicted)
+        return None if item is None else item[0]
+
+    def put(self, key, value):
+        """Caches the value, evicting the least recently used values."""
+        with self._lock:
+            if self.size:
+                expires = None if self.ttl is None \
+                    else perf_counter() + self.ttl
+                weight = 1 if self.weigh is None else self.weigh(value)
+                if key in self._items:
+                    self._weight -= self._items[key][2]
+                self._items[key] = (value, expires, weight)
+                self._items.move_to_end(key)
+                self._weight += weight
+            evicted = self._evict()
+        self._evicted(evicted)
+
+    def resize(self, size):
+        """Sets the maximum size and evicts any extra values."""
+        if size < 0:
+            raise ValueError("The cache size cannot be negative.")
+        with self._lock:
+            self.size = size
+            evicted = self._evict()
+        self._evicted(evicted)
+
+    def evict(self):
+        """Removes the expired values."""
+        with self._lock:
+            evicted = self._evict()
+        self._evicted(evicted)
+
+    def discard(self, test):
+        """Removes the values whose keys pass the test."""
+        with self._lock:
+            for key in [key for key in self._items if test(key)]:
+                self._weight -= self._items.pop(key)[2]
+
+    def clear(self):
+        """Removes all cached values."""
+        with self._lock:
+            self._items.clear()
+            self._weight = 0
+
+    def _evict(self):
+        evicted = []
+        if self.ttl is not None:
+            now = perf_counter()
+            for key in [key for key, (_, expires, _) in self._items.items()
+                        if expires <= now]:
+                value, _, weight = self._items.pop(key)
+                self._weight -= weight
+                evicted.append((key, value))
+        while self._items and self._weight > self.size:
+            key, (value, _, weight) = self._items.popitem(last=False)
+            self._weight -= weight
+            evicted.append((key, value))
+        return evicted
+
+    def _evicted(self, evicted):
+        # The callback runs outside the lock so that it can use the cache
+        if self.on_evict is not None:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+
+def _code_errors(code, used_codes):
+    """Returns the reasons why the pass code is invalid, if any."""
+    error = ""
+    if len(code) > 12 or len(code) < 6:
+        error += "The pass code should be 6 and 12 characters.\n"
+    if any([c not in REFERENCE_INDEX for c in code]):
+        error += "Invalid character used.\n"
+    if code in used_codes:
+        error += "Code is already used.\n"
+    duplicate_check = sorted(code)
+    if duplicate_check and duplicate_check[0] == duplicate_check[-1]:
+        error += "Code cannot consist of only one letter.\n"
+    return error
 
 
 def validate_code(user_defined, used_codes):
     """Validates user input codes."""
     while True:
-        error = ""
         code = input(user_defined).strip().upper()
-        if len(code) > 12 or len(code) < 6:
-            error += "The pass code should be 6 and 12 characters.\n"
-        if any([c not in REFERENCE_LIST for c in code]):
-            error += "Invalid character used.\n"
-        if code in used_codes:
-            error += "Code is already used.\n"
-        duplicate_check = code[:]
-        duplicate_check = sorted(duplicate_check)
-        if duplicate_check[0] == duplicate_check[-1]:
-            error += "Code cannot consist of only one letter.\n"
+        error = _code_errors(code, used_codes)
         if not error:
             used_codes.append(code)
             return code
         print(error)
 
 
+def check_codes(codes):
+    """
+    Checks three pass codes with the same rules as validate_code and
+    returns them in upper case.  Raises ValueError if any is invalid.
+    """
+    codes = [code.strip().upper() for code in codes]
+    if len(codes) != 3:
+        raise ValueError("Three pass codes are needed.")
+    used_codes = []
+    for i, code in enumerate(codes):
+        error = _code_errors(code, used_codes)
+        if error:
+            raise ValueError(f"Pass code {i + 1}: "
+                             + " ".join(error.splitlines()))
+        used_codes.append(code)
+    return codes
+
+
+def read_codes(path):
+    """Reads and checks three pass codes from a file, one per line."""
+    with open(path) as file:
+        return check_codes([line for line in file if line.strip()])
+
+
 def owncode():
     """Prompts for pass codes and validates them."""
     print("\nThe pass code must be between 6 and 12 characters:")
@@ -127,35 +344,97 @@ def validdate_message(message):
     added_spaces = len(message) // 6
     if (len(message) - added_spaces) % 24 != 0:
         return False
-    for c in message:
-        if c not in CODE_LETTER and c != ' ':
-            return False
-    return True
+    return _INVALID_CIPHERTEXT.search(message) is None
+
+
+# Ciphertexts only contain the code letters and a space after every five \
+# letters, so each sixth character is a space
+_INVALID_CIPHERTEXT = re.compile(f"[^{''.join(CODE_LETTER)} ]")
+_CIPHERTEXT_PATTERN = re.compile(
+    f"(?:[{''.join(CODE_LETTER)}]{{5}} )*[{''.join(CODE_LETTER)}]{{0,5}}")
+
+
+def _ciphertext_error(ciphertext):
+    """Returns the error and offset of one ciphertext, see below."""
+    if not isinstance(ciphertext, str):
+        return "type", 0
+    if not ciphertext:
+        return "empty", 0
+    invalid = _INVALID_CIPHERTEXT.search(ciphertext)
+    if invalid:
+        return "alphabet", invalid.start()
+    if not _CIPHERTEXT_PATTERN.fullmatch(ciphertext):
+        # The first character which is a space where a letter should be, \
+        # or the other way round
+        spaces = np.frombuffer(ciphertext.encode("ascii"),
+                               dtype=np.uint8) == ord(" ")
+        expected = np.arange(len(ciphertext)) % 6 == 5
+        return "spacing", int(np.argmax(spaces != expected))
+    letters = len(ciphertext) - len(ciphertext) // 6
+    if letters % 24 != 0:
+        return "length", len(ciphertext)
+    return None, None
+
+
+def validate_ciphertexts(ciphertexts):
+    """
+    Checks each ciphertext without deriving any key schedule, so invalid
+    messages can be dropped before decryption.  Returns an (error,
+    offset) pair for each ciphertext, which is (None, None) if it is
+    valid.  The errors are:
+    "type"      not a string
+    "empty"     an empty string
+    "alphabet"  offset of the first character which is not AMNVWXZ or a
+                space
+    "spacing"   offset of the first character which breaks the pattern
+                of a space after every five letters
+    "length"    the number of letters is not a multiple of 24, the
+                offset is the length
+    """
+    return [_ciphertext_error(ciphertext) for ciphertext in ciphertexts]
 
 def _substitute(text, spaces=True):
     """Substitutes spaces and removes invalid characters."""
-    ciphertext = ""
-    for c in text:
-        if c in REFERENCE_LIST:
-            cipher_letter = c
-        elif c == " " and spaces:
-            cipher_letter = "?"
-        else:
-            cipher_letter = ""
-        ciphertext += cipher_letter
-    return ciphertext
+    # Characters outside ASCII are never in the reference list, so they \
+    # are dropped before the bytes are translated
+    data = text.encode("ascii", "ignore")
+    if spaces:
+        data = data.translate(_SUBSTITUTE_TABLE, _SUBSTITUTE_DELETE)
+    else:
+        data = data.translate(None, _SUBSTITUTE_DELETE_SPACES)
+    return data.decode("ascii")
 
 
-def _add_random(ciphertext):
+def _add_random(ciphertext, rng=None):
     """
     Add random letters to the end of the plaintext until the message
     length is a multiple of 10
     """
-    if len(ciphertext) % 10 != 0:
-        ciphertext += "?"
-    while len(ciphertext) % 10 != 0:
-        ciphertext += choice(REFERENCE_LIST)
-    return ciphertext
+    # Any object with a choice method, such as random.Random, can be \
+    # given as the source of the random letters
+    random_choice = choice if rng is None else rng.choice
+    if len(ciphertext) % 10 == 0:
+        return ciphertext
+    padding = [random_choice(REFERENCE_LIST)
+               for _ in range(9 - len(ciphertext) % 10)]
+    return ciphertext + "?" + "".join(padding)
+
+
+class FixedPadding:
+    """
+    A source of random letters which returns the given letters in order,
+    so that an encryption can be repeated exactly.
+    """
+
+    def __init__(self, padding):
+        self._padding = iter(padding)
+
+    def choice(self, sequence):
+        """Returns the next padding letter."""
+        try:
+            return next(self._padding)
+        except StopIteration:
+            raise ValueError("Not enough padding letters.") from None
 
 
 def _add_two_random(ciphertext):
@@ -259,18 +538,9 @@ def _rearrangement(code1, code2, code3):
 
     # Finds the order of the numbers in the lists.
     # This is required for many of the permutations
-    code_order5 = []
-    for i in range(15):
-       temp =  _order(code[37 * i : 37 * i + 5])
-       code_order5.append(temp)
-    code_order6 = []
-    for i in range(11):
-       temp =  _order((code[19 * i : 19 * i + 6]))
-       code_order6.append(temp)
-    code_order24 = []
-    for i in range(13):
-       temp =  _order(code[29 * i : 29 * i + 24])
-       code_order24.append(temp)
+    code_order5 = _order([code[37 * i : 37 * i + 5] for i in range(15)])
+    code_order6 = _order([code[19 * i : 19 * i + 6] for i in range(11)])
+    code_order24 = _order([code[29 * i : 29 * i + 24] for i in range(13)])
     # The inverse order is required to reverse the permutations
     code_order5_inv = _get_inv_order(*code_order5)
     code_order6_inv = _get_inv_order(*code_order6)
@@ -288,174 +558,160 @@ def _rearrangement(code1, code2, code3):
 
 def _generate_code_list (code, total, first_list=False):
     """Generates a random-like sequence of numbers to be used for the codes"""
-    temp = []
-    for i in range(len(code)):
-        temp.append(((code[i] + i + 1) * 37 + total) % REFERENCE_LEN)
-    code = temp
+    code = np.asarray(code)
+    code = ((code + np.arange(1, len(code) + 1)) * 37 + total) \
+        % REFERENCE_LEN
     # All other functions are just permutations, or substitutions by \
     # adding constants or variables
     code = code[::-1]
-    temp = []
-    for k in range(code[5]):
-        temp = []
-        for j in range(len(code) // 2):
-            temp.append(code[2 * j + 1])
-        for j in range(len(code) // 2):
-            temp.append(code[2 * j])
-        code = temp
-    temp = []
-    for i in range(len(code)):
-        temp.append((code[i] + code[i % 13]) % REFERENCE_LEN)
-    code = temp
-    temp = [code[-1] % REFERENCE_LEN]
-    for i in range(len(code) - 1):
-        temp.append((temp[-1] + code[i]) % REFERENCE_LEN)
-    code = temp
-    code = [((element + code[12] + 55) * 161 % \
-             REFERENCE_LEN) for element in code]
+    code = code[_odds_evens_index(len(code), int(code[5]))]
+    code = (code + code[np.arange(len(code)) % 13]) % REFERENCE_LEN
+    code = _running_sum(code)
+    code = (code + code[12] + 55) * 161 % REFERENCE_LEN
     # This ensures again that the main list is processed in a \
     # different way to the orthogonal list
     if first_list:
-        temp_word = ""
-        for i in range(len(code)):
-            temp_word += CODE_LIST[code[i]]
-        code_word = ""
-        for j in range(len(temp_word) // 2):
-            code_word += temp_word[2 * j + 1]
-        for j in range(len(temp_word) // 2):
-            code_word += temp_word[2 * j]
-        temp_word = "".join(reversed(code_word))
-        code = ""
-        for j in range(len(temp_word) // 2):
-            temp = CODE_LIST.index(temp_word[2 * j] + temp_word[2 * j + 1])
-            code += REFERENCE_LIST[temp]
-        code = _shift(code)
-        code = code[0]
-    temp = []
-    for i in range(len(code)):
-        temp.append(((code[i] + i + 1) * 29 + 31) % REFERENCE_LEN)
-    code = temp
+        # The AMNVWXZ pairs are split into the second and first letters, \
+        # reversed and read back as pairs
+        letters = SYMBOL_LETTERS[code]
+        letters = np.concatenate([letters[:, 1], letters[:, 0]])[::-1]
+        code = LETTER_SYMBOLS[letters[0::2], letters[1::2]]
+    code = ((code + np.arange(1, len(code) + 1)) * 29 + 31) \
+        % REFERENCE_LEN
     code = code[::-1]
-    temp = []
-    for k in range(code[5]):
-        temp = []
-        for j in range(len(code) // 2):
-            temp.append(code[2 * j + 1])
-        for j in range(len(code) // 2):
-            temp.append(code[2 * j])
-        code = temp
-    temp = [code[-1] % REFERENCE_LEN]
-    for i in range(len(code) - 1):
-        temp.append((temp[-1] + code[i]) % REFERENCE_LEN)
-    code = temp
-    code = [((element + code[12] + 55) * 87 % \
-             REFERENCE_LEN) for element in code]
-    temp = []
-    for k in range(code[5]):
-        temp = []
-        for j in range(len(code) // 2):
-            temp.append(code[2 * j + 1])
-        for j in range(len(code) // 2):
-            temp.append(code[2 * j])
-        code = temp
-    temp = [code[-1] % REFERENCE_LEN]
-    for i in range(len(code) - 1):
-        temp.append((temp[-1] + code[i]) % REFERENCE_LEN)
-    code = temp
-    return code
+    code = code[_odds_evens_index(len(code), int(code[5]))]
+    code = _running_sum(code)
+    code = (code + code[12] + 55) * 87 % REFERENCE_LEN
+    code = code[_odds_evens_index(len(code), int(code[5]))]
+    code = _running_sum(code)
+    return code.tolist()
+
+
+def _running_sum(code):
+    """
+    Returns the running sum of the numbers, starting from the last
+    number, modulo the reference length.
+    """
+    return np.cumsum(np.concatenate([code[-1:], code[:-1]])) % REFERENCE_LEN
 
 
 def _order(code):
-    """Puts the elements into order and finds to order of the pass code."""
-    order = []
-    sorted_code = sorted(code)
-    for i, c in enumerate(code):
-        order.append(sorted_code.index(c))
-        sorted_code[order[i]] = "%"
-    return order
+    """
+    Puts the elements into order and finds to order of the pass code.
+    A 2D list is ordered row by row.
+    """
+    # The order of each element is its position in a stable sort, so \
+    # equal elements are ordered by their position in the code
+    code = np.asarray(code)
+    order = np.empty(code.shape, dtype=int)
+    np.put_along_axis(order, np.argsort(code, axis=-1, kind="stable"),
+                      np.arange(code.shape[-1]), axis=-1)
+    return order.tolist()
 
 
 def _shift(*codes):
     """Finds the shifts needed from the substitution code word."""
-    code_numbers = []
-    for code in codes:
-        code_number = []
-        for n in range(len(code)):
-            code_number.append(REFERENCE_LIST.index(code[n % len(code)]))
-        code_numbers.append(code_number)
-    return code_numbers
+    return [_encode(code) for code in codes]
+
+
+def _encode_bytes(text, table=_REFERENCE_ENCODE):
+    """Translates the text to a bytes object of list numbers."""
+    numbers = text.encode("ascii").translate(table)
+    if _INVALID in numbers:
+        raise ValueError("Invalid character used.")
+    return numbers
+
+
+def _encode(text):
+    """Converts the text to a list of reference list numbers."""
+    return list(_encode_bytes(text))
+
+
+def _decode(numbers):
+    """Converts reference list numbers back to text."""
+    if isinstance(numbers, np.ndarray):
+        numbers = numbers.astype(np.uint8).tobytes()
+    return bytes(numbers).translate(_REFERENCE_DECODE).decode("ascii")
+
+
+def _decode_pairs(numbers):
+    """Converts reference list numbers to the AMNVWXZ code list pairs."""
+    return _decode(numbers).translate(_CODE_PAIR_TABLE)
 
 
 def _get_inv_order(*orders):
     """Calculates and returns inverse matrix."""
-    code = orders[0]
-    inv_order = []
-    for order in (orders):
-        order_inv = [order.index(i) for i, _ in enumerate(code)]
+    # Each order is a permutation, so sorting it gives its inverse
+    return np.argsort(np.array(orders), axis=-1).tolist()
 
-        inv_order.append(order_inv)
-    return inv_order
 
-
-def _adds_spaces(ciphertext):
-    """Adds one space for every five characters in the final ciphertext."""
-    temp_word = ""
-    for j in range(len(ciphertext) // 5):
-        temp_word += ciphertext [j * 5 : j * 5 + 5] + " "
-    if len(ciphertext) % 5 != 0:
-        for k in range (len(ciphertext) % 5):
-            temp_word +=  ciphertext[k - len(ciphertext) % 5]
-    ciphertext = temp_word
-    return ciphertext
+def _adds_spaces(ciphertext, out=None):
+    """
+    Adds one space for every five characters in the final ciphertext.
+    If a writable buffer is given as out, the text is written into it as
+    ASCII and the number of bytes written is returned instead.
+    """
+    # Every full group of five is followed by a space, the last partial \
+    # group is not
+    full = len(ciphertext) - len(ciphertext) % 5
+    groups = [ciphertext[j:j + 5] for j in range(0, full, 5)]
+    groups.append(ciphertext[full:])
+    ciphertext = " ".join(groups)
+    if out is None:
+        return ciphertext
+    return _write_ascii(ciphertext, out)
+
+
+def _reinstate_space(ciphertext, out=None):
+    """
+    Converts the ? back into a space.  If a writable buffer is given as
+    out, the text is written into it and the number of bytes is returned.
+    """
+    ciphertext = ciphertext.replace("?", " ")
+    if out is None:
+        return ciphertext
+    return _write_ascii(ciphertext, out)
 
 
-def _reinstate_space(ciphertext):
-    """Converts the ? back into a space."""
-    temp_word = ""
-    for c in ciphertext:
-        if c == "?":
-            cipher_letter = " "
-        else:
-            cipher_letter = c
-        temp_word += cipher_letter
-    ciphertext = temp_word
-    return ciphertext
+def _write_ascii(text, out):
+    """Writes the text into the start of the buffer as ASCII."""
+    data = text.encode("ascii")
+    view = memoryview(out).cast("B")
+    if len(data) > len(view):
+        raise ValueError("The buffer is too small for the message.")
+    view[:len(data)] = data
+    return len(data)
 
 
 def _get_cipher_number(ciphertext):
     """Finds the AMNVWXZ reference number of the array letters."""
-    cipher_number = []
-    for j in range(len(ciphertext) // 2):
-        code = ciphertext[2 * j] + ciphertext[2 * j + 1]
-        cipher_number.append(CODE_LIST.index(code))
-    return cipher_number
+    try:
+        return [CODE_INDEX[ciphertext[2 * j: 2 * j + 2]]
+                for j in range(len(ciphertext) // 2)]
+    except KeyError:
+        raise ValueError("Invalid character used.") from None
 
 
 def _vigenere(ciphertext, code_reference, i, cycle, decrypt=False):
     """Encrypts or decrypts using the message Vigenere / Bellaso cipher."""
-    temp_word = ""
-    code_number = []
     mult = 1
     if decrypt:
         # Multiplying by -1 is needed for the decryption
         mult = -1
         # The order of the list needs to be reverse for decryption
         i = cycle - 1 - i
-    for n in range(len(ciphertext)):
-        code_number.append(
-            mult * code_reference[i % len(code_reference)][n % \
-                                len(code_reference[i % len(code_reference)])])
-    for j in range(len(ciphertext)):
-        index = REFERENCE_LIST.index(
-            ciphertext[j]) - code_number[j] % REFERENCE_LEN
-        temp_word += REFERENCE_LIST[index]
-    ciphertext = temp_word
+    code = code_reference[i % len(code_reference)]
+    cipher_number = _encode(ciphertext)
+    for j in range(len(cipher_number)):
+        cipher_number[j] = (cipher_number[j] - mult * code[j % len(code)]) \
+            % REFERENCE_LEN
+    ciphertext = _decode(cipher_number)
     return ciphertext
 
 
 def _bellaso(ciphertext, code_reference, i, cycle, decrypt=False):
     """Encrypts or decrypts using the message Vigenere / Bellaso cipher."""
-    temp_word = ""
+    code_number = []
     cipher_number = _get_cipher_number(ciphertext)
     mult = 1
     if decrypt:
@@ -474,8 +730,8 @@ def _bellaso(ciphertext, code_reference, i, cycle, decrypt=False):
         temp = mult * 37 * code_reference[i % len(code_reference)][\
                     (2 * j + 1) % len(code_reference[i % len(code_reference)])]
         index2 = (cipher_number[2 * j + 1] - temp) % REFERENCE_LEN
-        temp_word += CODE_LIST[index1] + CODE_LIST[index2]
-    ciphertext = temp_word
+        code_number += [index1, index2]
+    ciphertext = _decode_pairs(code_number)
     return ciphertext
 
 
@@ -483,21 +739,13 @@ def _2D_array(ciphertext):
     """ Converts the letters to a 2D array as per the code list."""
     # The letters are converted as per an array but rather by the index \
     # of the code list constant
-    temp_word = ""
-    for j in range(len(ciphertext)):
-        temp = REFERENCE_LIST.index(ciphertext[j])
-        temp_word += CODE_LIST[temp]
-    ciphertext = temp_word
+    ciphertext = ciphertext.translate(_CODE_PAIR_TABLE)
     return ciphertext
 
 
 def _retrun_from_array(ciphertext):
     """ Converts the back to single letters as per the reference list."""
-    temp_word = ""
-    for j in range(len(ciphertext) // 2):
-        temp = CODE_LIST.index(ciphertext[2 * j] + ciphertext[2 * j + 1])
-        temp_word += REFERENCE_LIST[temp]
-    ciphertext = temp_word
+    ciphertext = _decode(_get_cipher_number(ciphertext))
     return ciphertext
 
 
@@ -506,39 +754,15 @@ def _chain_addition(ciphertext, code_a, code_b, i, array_letter=False):
     Adds the value of the current letter
     with the value of the last letter in the new word.
     """
-    temp_word = ""
-    cipher_number = []
     if array_letter:
-        cipher_number = _get_cipher_number(ciphertext)
+        cipher_number = np.array(_get_cipher_number(ciphertext), dtype=int)
     else:
-        for j in range(len(ciphertext)):
-            code = ciphertext[j]
-            cipher_number.append(REFERENCE_LIST.index(code))
-    # The first number is taken from a code list
-    # All other numbers taken from the message
-    cipher_number2 = [(code_a[i % len(code_a)] + 1 + \
-                       cipher_number[0]) % REFERENCE_LEN]
-    for j in range(len(cipher_number) - 1):
-        temp = cipher_number2[-1] + cipher_number[j + 1]
-        cipher_number2.append(temp % REFERENCE_LEN)
-    # Once the numbers have been added from start to the end of the message,
-    # The numbers are added again from the end of the message to the start
-    # Adding numbers form both ends means that any one character difference \
-    # in the message would effect all characters
-    temp = code_b[i % len(code_b)] + cipher_number2[len(cipher_number2) - 1]
-    cipher_number3 = [temp % REFERENCE_LEN]
-    for j in range(len(cipher_number2) - 1):
-        temp = cipher_number3[0] + cipher_number2[len(cipher_number2) - 2 - j]
-        cipher_number3.insert(0, temp % REFERENCE_LEN)
+        cipher_number = _text_to_numbers(ciphertext)
+    cipher_number = _chain_addition_numbers(cipher_number, code_a, code_b, i)
     if array_letter:
-        for j in range(len(cipher_number3)):
-            index = CODE_LIST[cipher_number3[j]]
-            temp_word += index
+        ciphertext = _decode_pairs(cipher_number)
     else:
-        for j in range(len(cipher_number3)):
-            index = REFERENCE_LIST[cipher_number3[j]]
-            temp_word += index
-    ciphertext = temp_word
+        ciphertext = _decode(cipher_number)
     return ciphertext
 
 
@@ -547,74 +771,31 @@ def _chain_sub(ciphertext, code_a, code_b, i, cycle, array_letter= False):
     Subtracts the value of the current letter
     with the value of the last letter in the new word.
     """
-    codelist1 = []
-    codelist2 = []
-    codelist3 = []
-    i = cycle - 1 - i
     if array_letter:
-        codelist1 = _get_cipher_number(ciphertext)
-    else:
-        for j in range(len(ciphertext)):
-            codelist1.append(REFERENCE_LIST.index(ciphertext[j]))
-    # Subtracts The first number by the second number
-    # The the resulting number by the thrid number and so forth
-    for j in range(len(codelist1) - 1):
-        difference = codelist1[j] - codelist1[j + 1]
-        if difference >= 0:
-            value = difference
-        else:
-            value = codelist1[j] + (REFERENCE_LEN - codelist1[j + 1])
-        codelist2.append(value)
-    # The last number is subtracted by the code list number
-    # The remaining number is eliminated as this number was from the code list
-    difference = codelist1[j + 1] - code_b[i % len(code_b)]
-    if difference >= 0:
-        value = difference
+        cipher_number = np.array(_get_cipher_number(ciphertext), dtype=int)
     else:
-        value = codelist1[j + 1] + (REFERENCE_LEN - code_b[i % len(code_b)])
-    codelist2.append(value)
-    # The process repeats going from the other end of the message
-    # Subtracts The last number by the second last number
-    # The the resulting number by the thrid last number and so forth
-    for j in range(len(codelist2) - 1):
-        difference = codelist2[-1 - j] - codelist2[-2 - j]
-        if difference >= 0:
-            value = difference
-        else:
-            value = codelist2[-1 - j] + (REFERENCE_LEN - codelist2[-2 - j])
-        codelist3.insert(0, value)
-    # The first number is subtracted by the code list number
-    # The remaining number is eliminated as this number was from the code list
-    difference = codelist2[0] - code_a[i % len(code_a)] - 1
-    if difference >= 0:
-        value = difference
-    else:
-        value = codelist2[0] + (REFERENCE_LEN - code_a[i % len(code_a)] - 1)
-    codelist3.insert(0, value)
-    temp_word = ""
+        cipher_number = _text_to_numbers(ciphertext)
+    cipher_number = _chain_sub_numbers(cipher_number, code_a, code_b, i, cycle)
     if array_letter:
-        for j in range(len(codelist3)):
-            temp_word += CODE_LIST[codelist3[j]]
+        ciphertext = _decode_pairs(cipher_number)
     else:
-        for j in range(len(codelist3)):
-            temp_word += REFERENCE_LIST[codelist3[j]]
-    ciphertext = temp_word
+        ciphertext = _decode(cipher_number)
     return ciphertext
 
 
 def _get_matrix(cipher_number, hill_matrix, cycle_number):
-    """Takes a fragment of the number list and multiples by the
-    inverse mod Hill matrix, then adds the product into a new list."""
-    code_matrix = []
+    """Splits the number list into fragments of four and multiples every
+    fragment by the (inverse) mod Hill matrix in a single product."""
     # Multiplies the matrices together mean that the value of the is a \
     # function of the number, its three adjacent numbers and its position \
     # in the 1D matrix
-    for n in range(cycle_number):
-        fragment = cipher_number[n * 4 : n * 4 + 4]
-        fragment = (hill_matrix.dot(fragment) % REFERENCE_LEN).tolist()
-        for frag in fragment:
-            code_matrix.append(frag)
-    return code_matrix
+    # The numbers can also be a 2D array of equal length messages, each \
+    # row is then split into its own fragments
+    cipher_number = np.asarray(cipher_number)
+    fragments = cipher_number[..., :cycle_number * 4].reshape(
+        cipher_number.shape[:-1] + (cycle_number, 4))
+    code_matrix = fragments @ hill_matrix.T % REFERENCE_LEN
+    return code_matrix.reshape(cipher_number.shape[:-1] + (-1,))
 
 
 def _hill_function(ciphertext, decrypt=False):
@@ -625,24 +806,65 @@ def _hill_function(ciphertext, decrypt=False):
         code_matrix = _get_matrix(cipher_number, HILL_MATRIX_INV, cycle)
     else:
         code_matrix = _get_matrix(cipher_number, HILL_MATRIX, cycle)
-    temp_word = ""
-    for code in code_matrix:
-        temp_word = temp_word + CODE_LIST[code]
-    ciphertext = temp_word
+    ciphertext = _decode_pairs(code_matrix)
     return ciphertext
 
 
+# Grouping the odd and even letters is a fixed permutation, so grouping \
+# them k times is the k-th power of that permutation.  The powers are \
+# cached per length and number of times.
+_ODDS_EVENS_CACHE = _LRUCache(256)
+
+
+def _odds_evens_index(length, count, back=False):
+    """
+    Returns the index array which groups the odd and even positions
+    the given number of times, or groups them back if back is set.
+    """
+    key = (length, count, back)
+    index = _ODDS_EVENS_CACHE.get(key)
+    if index is not None:
+        return index
+    index = np.arange(length, dtype=np.intp)
+    if count and back:
+        index = _invert(_odds_evens_index(length, count))
+    elif count:
+        # The last letter of an odd length is dropped by the first grouping
+        even = length - length % 2
+        grouping = np.concatenate((np.arange(1, even, 2, dtype=np.intp),
+                                   np.arange(0, even, 2, dtype=np.intp)))
+        # The remaining groupings are applied by repeated squaring
+        index = grouping
+        count -= 1
+        while count:
+            if count & 1:
+                index = index[grouping]
+            grouping = grouping[grouping]
+            count >>= 1
+    _ODDS_EVENS_CACHE.put(key, index)
+    return index
+
+
+def _invert(index):
+    """Returns the index array which undoes the gather by the index."""
+    inverse = np.empty_like(index)
+    inverse[index] = np.arange(len(index), dtype=index.dtype)
+    return inverse
+
+
+def _gather_text(text, index):
+    """Returns the characters of the text in the order of the index."""
+    letters = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    return letters[index].tobytes().decode("ascii")
+
+
 def _odds_evens(ciphertext, code_reference, i):
     """Groups the odd and even letters numerous times as per the code list."""
     # Since the letters are from a 2D array, rearranging the order will \
     # result in different code list index numbers
-    for k in range(code_reference[i % (len(code_reference))] + 1):
-        temp_word = ""
-        for j in range(len(ciphertext) // 2):
-            temp_word += ciphertext[2 * j + 1]
-        for j in range(len(ciphertext) // 2):
-            temp_word += ciphertext[2 * j]
-        ciphertext = temp_word
+    index = _odds_evens_index(
+        len(ciphertext), code_reference[i % (len(code_reference))] + 1)
+    ciphertext = _gather_text(ciphertext, index)
     return ciphertext
 
 
@@ -652,11 +874,9 @@ def _back_odd_evens(ciphertext, code_reference, i, cycle):
     as dictated by the code list.
     """
     i = cycle - 1 - i
-    for k in range(code_reference[i % (len(code_reference))] + 1):
-        temp_word = ""
-        for j in range(len(ciphertext) // 2):
-            temp_word += ciphertext[len(ciphertext) // 2 + j] + ciphertext[j]
-        ciphertext = temp_word
+    index = _odds_evens_index(
+        len(ciphertext), code_reference[i % (len(code_reference))] + 1, True)
+    ciphertext = _gather_text(ciphertext, index)
     return ciphertext
 
 
@@ -742,17 +962,2294 @@ def _back_transposition(ciphertext, code_order, i, cycle):
     return ciphertext
 
 
-def encrypt(codes, plaintext):
-    """Encrypts the given plaintext with the given codes."""
+# The array engine keeps the message as an array of numbers from entry \
+# until the final text is formed.  Each function below matches one of the \
+# string functions above but works along the last axis, so that a 2D array \
+# of equal length messages can be processed in one call.
+def _text_to_numbers(text):
+    """Converts the text to an array of reference list numbers."""
+    return np.frombuffer(_encode_bytes(text), dtype=np.uint8).astype(int)
+
+
+def _numbers_to_text(numbers):
+    """Converts an array of reference list numbers back to text."""
+    return _decode(numbers)
+
+
+def _text_to_letters(text):
+    """Converts AMNVWXZ text to an array of code letter numbers."""
+    letters = _encode_bytes(text, _LETTER_ENCODE)
+    return np.frombuffer(letters, dtype=np.uint8).astype(int)
+
+
+def _letters_to_text(letters):
+    """Converts an array of code letter numbers back to AMNVWXZ text."""
+    letters = letters.astype(np.uint8).tobytes()
+    return letters.translate(_LETTER_DECODE).decode("ascii")
+
+
+def _to_letters(numbers):
+    """Converts reference numbers into pairs of code letter numbers."""
+    return SYMBOL_LETTERS[numbers].reshape(numbers.shape[:-1] + (-1,))
+
+
+def _to_symbols(letters):
+    """Converts pairs of code letter numbers back into reference numbers."""
+    return LETTER_SYMBOLS[letters[..., 0::2], letters[..., 1::2]]
+
+
+def _add_two_random_numbers(numbers):
+    """Adds the two ^ numbers for every 10 numbers."""
+    blocks = numbers.reshape(numbers.shape[:-1] + (-1, 10))
+    # The ^ character is the first number in the reference list
+    padded = np.zeros(blocks.shape[:-1] + (12,), dtype=numbers.dtype)
+    padded[..., 1:11] = blocks
+    return padded.reshape(numbers.shape[:-1] + (-1,))
+
+
+def _remove_two_random_numbers(numbers):
+    """Removes the two added numbers for every 12 numbers."""
+    blocks = numbers.reshape(numbers.shape[:-1] + (-1, 12))
+    return blocks[..., 1:11].reshape(numbers.shape[:-1] + (-1,))
+
+
+def _vigenere_numbers(numbers, code_reference, i, cycle, decrypt=False):
+    """Vigenere / Bellaso cipher on an array of numbers."""
+    if decrypt:
+        i = cycle - 1 - i
+    code = code_reference[i % len(code_reference)]
+    code_number = np.resize(np.array(code), numbers.shape[-1])
+    if decrypt:
+        return (numbers + code_number) % REFERENCE_LEN
+    return (numbers - code_number) % REFERENCE_LEN
+
+
+def _bellaso_numbers(numbers, code_reference, i, cycle, decrypt=False):
+    """Vigenere / Bellaso cipher on an array of code list numbers."""
+    if decrypt:
+        i = cycle - 1 - i
+    code = code_reference[i % len(code_reference)]
+    code_number = 37 * np.resize(np.array(code), numbers.shape[-1])
+    # The code number is added to the first number of each pair and
+    # subtracted from the second, the opposite occurs for decryption
+    code_number[1::2] *= -1
+    if decrypt:
+        code_number = -code_number
+    return (numbers + code_number) % REFERENCE_LEN
+
+
+def _chain_addition_numbers(numbers, code_a, code_b, i):
+    """Chain addition from both ends of an array of numbers."""
+    # The first number is taken from a code list
+    # All other numbers taken from the message, so each new number is \
+    # the cumulative sum of the message up to that point
+    first = code_a[i % len(code_a)] + 1
+    forward = (np.cumsum(numbers, axis=-1) + first) % REFERENCE_LEN
+    # Once the numbers have been added from start to the end of the message,
+    # The numbers are added again from the end of the message to the start
+    # Adding numbers form both ends means that any one character difference \
+    # in the message would effect all characters
+    backward = np.cumsum(forward[..., ::-1], axis=-1)[..., ::-1]
+    return (backward + code_b[i % len(code_b)]) % REFERENCE_LEN
+
+
+def _chain_sub_numbers(numbers, code_a, code_b, i, cycle):
+    """Reverses the chain addition of an array of numbers."""
+    i = cycle - 1 - i
+    # Subtracts the second number from the first number, the third number \
+    # from the second and so forth
+    # The last number is subtracted by the code list number
+    forward = -np.diff(numbers, axis=-1, append=code_b[i % len(code_b)]) \
+        % REFERENCE_LEN
+    # The process repeats going from the other end of the message
+    # The first number is subtracted by the code list number
+    return np.diff(forward, axis=-1, prepend=code_a[i % len(code_a)] + 1) \
+        % REFERENCE_LEN
+
+
+def _hill_numbers(numbers, decrypt=False):
+    """Multiplies each block of four numbers by the Hill matrix."""
+    hill_matrix = HILL_MATRIX_INV if decrypt else HILL_MATRIX
+    return _get_matrix(numbers, hill_matrix, numbers.shape[-1] // 4)
+
+
+def _odds_evens_numbers(numbers, code_reference, i):
+    """Groups the odd and even numbers as per the code list."""
+    index = _odds_evens_index(
+        numbers.shape[-1], code_reference[i % (len(code_reference))] + 1)
+    return numbers[..., index]
+
+
+def _back_odd_evens_numbers(numbers, code_reference, i, cycle):
+    """Groups back the odd and even numbers as per the code list."""
+    i = cycle - 1 - i
+    index = _odds_evens_index(
+        numbers.shape[-1], code_reference[i % (len(code_reference))] + 1,
+        True)
+    return numbers[..., index]
+
+
+def _reversal_numbers(numbers):
+    """Reverses the order of the numbers."""
+    return numbers[..., ::-1]
+
+
+def _rearrange_numbers(numbers, order_code, i, cycle, decrypt=False):
+    """Rearranges the numbers within each section."""
+    code_len = len(order_code[i % len(order_code)])
+    if decrypt:
+        i = cycle - 1 - i
+    order = order_code[i % len(order_code)]
+    sections = numbers.reshape(numbers.shape[:-1] + (-1, code_len))
+    return sections[..., order].reshape(numbers.shape)
+
+
+def _group_rearrange_numbers(numbers, order_code, i):
+    """Rearranges the sections of numbers."""
+    order = order_code[i % len(order_code)]
+    sections = numbers.reshape(numbers.shape[:-1] + (len(order), -1))
+    return sections[..., order, :].reshape(numbers.shape)
+
+
+def _group_back_numbers(numbers, inv_matrix, i, cycle):
+    """Returns sections of numbers back to original position."""
+    return _group_rearrange_numbers(numbers, inv_matrix, cycle - 1 - i)
+
+
+def _transposition_numbers(numbers, code_order, i):
+    """Transposes the numbers by columns as per the code order."""
+    order = code_order[i % len(code_order)]
+    inv_order = [order.index(k) for k in range(len(order))]
+    table = numbers.reshape(numbers.shape[:-1] + (-1, len(order)))
+    table = table[..., inv_order].swapaxes(-1, -2)
+    return table.reshape(numbers.shape)
+
+
+def _back_transposition_numbers(numbers, code_order, i, cycle):
+    """Transposes the numbers back to the original position."""
+    i = cycle - 1 - i
+    order = code_order[i % len(code_order)]
+    table = numbers.reshape(numbers.shape[:-1] + (len(order), -1))
+    table = table[..., order, :].swapaxes(-1, -2)
+    return table.reshape(numbers.shape)
+
+
+def _encrypt_numbers(schedule, numbers):
+    """
+    Runs stages A to R on the reference numbers of the padded plaintext
+    and returns the code letter numbers of the ciphertext.
+    """
+    code_reference = schedule.code_reference
+    code_order5 = schedule.code_order5
+    code_order6 = schedule.code_order6
+    code_order24 = schedule.code_order24
+    code_a = schedule.code_a
+    code_b = schedule.code_b
+    cycle = schedule.cycle
+    profiler = _active_profiler()
+    if profiler:
+        profiler.start()
+
+    for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
+        numbers = _vigenere_numbers(numbers, code_reference, i, cycle)
+        if profiler:
+            profiler.lap("A", numbers)
+        numbers = _rearrange_numbers(numbers, code_order5, i, cycle)
+        if profiler:
+            profiler.lap("B", numbers)
+        numbers = _odds_evens_numbers(numbers, code_a, i)
+        if profiler:
+            profiler.lap("C", numbers)
+        numbers = _chain_addition_numbers(numbers, code_b, code_a, i)
+        if profiler:
+            profiler.lap("D", numbers)
+        numbers = _reversal_numbers(numbers)
+        if profiler:
+            profiler.lap("E", numbers)
+        numbers = _group_rearrange_numbers(numbers, code_order5, i)
+        if profiler:
+            profiler.lap("F", numbers)
+            profiler.end_cycle("phase one")
+
+    numbers = _add_two_random_numbers(numbers)
+    if profiler:
+        profiler.lap("G", numbers)
+    letters = _to_letters(numbers)
+    if profiler:
+        profiler.lap("H", letters)
+
+    for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
+        letters = _transposition_numbers(letters, code_order6, i)
+        if profiler:
+            profiler.lap("I", letters)
+        letters = _reversal_numbers(letters)
+        if profiler:
+            profiler.lap("J", letters)
+        letters = _to_letters(_hill_numbers(_to_symbols(letters)))
+        if profiler:
+            profiler.lap("K", letters)
+        letters = _rearrange_numbers(letters, code_order6, i, cycle)
+        if profiler:
+            profiler.lap("L", letters)
+        letters = _group_rearrange_numbers(letters, code_order24, i)
+        if profiler:
+            profiler.lap("M", letters)
+        letters = _to_letters(_chain_addition_numbers(
+            _to_symbols(letters), code_a, code_b, i))
+        if profiler:
+            profiler.lap("N", letters)
+        letters = _odds_evens_numbers(letters, code_a, i)
+        if profiler:
+            profiler.lap("O", letters)
+        letters = _rearrange_numbers(letters, code_order24, i, cycle)
+        if profiler:
+            profiler.lap("P", letters)
+        letters = _group_rearrange_numbers(letters, code_order6, i)
+        if profiler:
+            profiler.lap("Q", letters)
+        letters = _to_letters(_bellaso_numbers(
+            _to_symbols(letters), code_reference, i, cycle))
+        if profiler:
+            profiler.lap("R", letters)
+            profiler.end_cycle("phase two")
+    return letters
+
+
+def _check_letter_count(count):
+    """Checks the ciphertext letters make whole blocks of 24 letters."""
+    if count % 24 != 0:
+        raise ValueError("The encrypted message should be a multiple of "
+                         "24 letters.")
+
+
+def _decrypt_numbers(schedule, letters):
+    """
+    Runs stages R to A in reverse on the code letter numbers of the
+    ciphertext and returns the reference numbers of the padded plaintext.
+    """
+    code_reference = schedule.code_reference
+    code_order6 = schedule.code_order6
+    code_a = schedule.code_a
+    code_b = schedule.code_b
+    code_order5_inv = schedule.code_order5_inv
+    code_order6_inv = schedule.code_order6_inv
+    code_order24_inv = schedule.code_order24_inv
+    cycle = schedule.cycle
+    _check_letter_count(letters.shape[-1])
+    profiler = _active_profiler()
+    if profiler:
+        profiler.start()
+
+    for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
+        letters = _to_letters(_bellaso_numbers(
+            _to_symbols(letters), code_reference, i, cycle, True))
+        if profiler:
+            profiler.lap("R", letters)
+        letters = _group_back_numbers(letters, code_order6_inv, i, cycle)
+        if profiler:
+            profiler.lap("Q", letters)
+        letters = _rearrange_numbers(letters, code_order24_inv, i, cycle,
+                                     True)
+        if profiler:
+            profiler.lap("P", letters)
+        letters = _back_odd_evens_numbers(letters, code_a, i, cycle)
+        if profiler:
+            profiler.lap("O", letters)
+        letters = _to_letters(_chain_sub_numbers(
+            _to_symbols(letters), code_a, code_b, i, cycle))
+        if profiler:
+            profiler.lap("N", letters)
+        letters = _group_back_numbers(letters, code_order24_inv, i, cycle)
+        if profiler:
+            profiler.lap("M", letters)
+        letters = _rearrange_numbers(letters, code_order6_inv, i, cycle, True)
+        if profiler:
+            profiler.lap("L", letters)
+        letters = _to_letters(_hill_numbers(_to_symbols(letters), True))
+        if profiler:
+            profiler.lap("K", letters)
+        letters = _reversal_numbers(letters)
+        if profiler:
+            profiler.lap("J", letters)
+        letters = _back_transposition_numbers(letters, code_order6, i, cycle)
+        if profiler:
+            profiler.lap("I", letters)
+            profiler.end_cycle("phase two")
+
+    numbers = _to_symbols(letters)
+    if profiler:
+        profiler.lap("H", numbers)
+    numbers = _remove_two_random_numbers(numbers)
+    if profiler:
+        profiler.lap("G", numbers)
+
+    for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
+        numbers = _group_back_numbers(numbers, code_order5_inv, i, cycle)
+        if profiler:
+            profiler.lap("F", numbers)
+        numbers = _reversal_numbers(numbers)
+        if profiler:
+            profiler.lap("E", numbers)
+        numbers = _chain_sub_numbers(numbers, code_b, code_a, i, cycle)
+        if profiler:
+            profiler.lap("D", numbers)
+        numbers = _back_odd_evens_numbers(numbers, code_a, i, cycle)
+        if profiler:
+            profiler.lap("C", numbers)
+        numbers = _rearrange_numbers(numbers, code_order5_inv, i, cycle, True)
+        if profiler:
+            profiler.lap("B", numbers)
+        numbers = _vigenere_numbers(numbers, code_reference, i, cycle, True)
+        if profiler:
+            profiler.lap("A", numbers)
+            profiler.end_cycle("phase one")
+    return numbers
+
+
+def _encrypt_text(schedule, plaintext, encrypt_numbers, rng=None,
+                  out=None):
+    """
+    Encrypts the plaintext with the given array engine stages, writing
+    the ciphertext into the out buffer if one is given.
+    """
+    profiler = _active_profiler()
+    if profiler:
+        profiler.start()
+    ciphertext = _add_random(_substitute(plaintext.upper()), rng)
+    numbers = _text_to_numbers(ciphertext)
+    if profiler:
+        profiler.lap("input", numbers)
+    letters = encrypt_numbers(schedule, numbers)
+    ciphertext = _adds_spaces(_letters_to_text(letters), out)
+    if profiler:
+        profiler.lap("S", ciphertext)
+    return ciphertext
+
+
+def _decrypt_text(schedule, ciphertext, decrypt_numbers, out=None):
+    """
+    Decrypts the ciphertext with the given array engine stages, writing
+    the plaintext into the out buffer if one is given.
+    """
+    profiler = _active_profiler()
+    if profiler:
+        profiler.start()
+    letters = _text_to_letters(_substitute(ciphertext, spaces=False))
+    if profiler:
+        profiler.lap("S", letters)
+    numbers = decrypt_numbers(schedule, letters)
+    plaintext = _reinstate_space(_numbers_to_text(numbers), out)
+    if profiler:
+        profiler.lap("output", plaintext)
+    return plaintext
+
+
+def _encrypt_array(schedule, plaintext, rng=None):
+    """Encrypts the plaintext with the array engine."""
+    return _encrypt_text(schedule, plaintext, _encrypt_numbers, rng)
+
+
+def _decrypt_array(schedule, ciphertext):
+    """Decrypts the ciphertext with the array engine."""
+    return _decrypt_text(schedule, ciphertext, _decrypt_numbers)
+
+
+# The permutation stages only depend on the key schedule, the cycle and \
+# the message length.  Each run of permutations between two substitution \
+# stages is composed into a single index array by applying the stages to \
+# the positions 0, 1, 2 ... so a cycle becomes gather, substitution, gather.
+# A plan of a long message with many cycles takes tens of megabytes, so \
+# the plans are kept up to a total number of bytes.
+_PLAN_CACHE = _LRUCache(64 * 1024 * 1024, weigh=lambda plan: sum(
+    index.nbytes for phase in plan for indices in phase for index in indices))
+
+
+def set_plan_cache_size(size):
+    """Sets the most bytes of permutation plans kept."""
+    _PLAN_CACHE.resize(size)
+
+
+def _compile_plan(schedule, length, decrypt=False):
+    """
+    Composes the permutations of both phases for a padded plaintext of
+    the given length.  Returns the phase one (B + C, E + F) and phase two
+    (I + J, L + M, O + P + Q) index arrays of every cycle.  The decrypt
+    plan holds the inverse index arrays, still in the encryption order.
+    The indices are stored as 32 bit integers to halve the plan size.
+    """
+    code_order5 = schedule.code_order5
+    code_order6 = schedule.code_order6
+    code_order24 = schedule.code_order24
+    code_a = schedule.code_a
+    cycle = schedule.cycle
+    # Phase two has two random characters for every 10 and two letters \
+    # for each character
+    positions = np.arange(length, dtype=np.intp)
+    letter_positions = np.arange(length // 10 * 24, dtype=np.intp)
+
+    phase_one = []
+    for i in range(cycle):
+        first = _rearrange_numbers(positions, code_order5, i, cycle)
+        first = _odds_evens_numbers(first, code_a, i)
+        second = _reversal_numbers(positions)
+        second = _group_rearrange_numbers(second, code_order5, i)
+        phase_one.append((first, second))
+
+    phase_two = []
+    for i in range(cycle):
+        first = _transposition_numbers(letter_positions, code_order6, i)
+        first = _reversal_numbers(first)
+        second = _rearrange_numbers(letter_positions, code_order6, i, cycle)
+        second = _group_rearrange_numbers(second, code_order24, i)
+        third = _odds_evens_numbers(letter_positions, code_a, i)
+        third = _rearrange_numbers(third, code_order24, i, cycle)
+        third = _group_rearrange_numbers(third, code_order6, i)
+        phase_two.append((first, second, third))
+
+    if decrypt:
+        phase_one = [tuple(_invert(index) for index in indices)
+                     for indices in phase_one]
+        phase_two = [tuple(_invert(index) for index in indices)
+                     for indices in phase_two]
+    phase_one = [tuple(index.astype(np.int32) for index in indices)
+                 for indices in phase_one]
+    phase_two = [tuple(index.astype(np.int32) for index in indices)
+                 for indices in phase_two]
+    return phase_one, phase_two
+
+
+def _get_plan(schedule, length, decrypt=False):
+    """Returns the permutation plan, compiling it if not cached."""
+    key = (schedule, length, decrypt)
+    plan = _PLAN_CACHE.get(key)
+    if plan is None:
+        plan = _compile_plan(schedule, length, decrypt)
+        _PLAN_CACHE.put(key, plan)
+    return plan
+
+
+# The Vigenere and Bellaso keystreams only depend on the key schedule, the \
+# cycle and the message length, so they are built once for every cycle
+_KEYSTREAM_CACHE = _LRUCache(16)
+
+
+def set_keystream_cache_size(size):
+    """Sets the number of Vigenere and Bellaso keystreams kept."""
+    _KEYSTREAM_CACHE.resize(size)
+
+
+def _compile_keystreams(schedule, length):
+    """
+    Returns the Vigenere keystream of each cycle for a padded plaintext
+    of the given length and the Bellaso keystream of each cycle for its
+    phase two symbols, both in the encryption order.
+    """
+    code_reference = schedule.code_reference
+    cycles = range(schedule.cycle)
+    vigenere = np.array([np.resize(code_reference[i % len(code_reference)],
+                                   length) for i in cycles], dtype=np.uint8)
+    # The Bellaso code numbers are added to the first symbol of each pair \
+    # and subtracted from the second
+    bellaso = np.array([np.resize(code_reference[i % len(code_reference)],
+                                  length // 10 * 12) for i in cycles]) * 37
+    bellaso[:, 1::2] *= -1
+    return vigenere, (bellaso % REFERENCE_LEN).astype(np.uint8)
+
+
+def _get_keystreams(schedule, length):
+    """Returns the keystreams, building them if not cached."""
+    key = (schedule, length)
+    keystreams = _KEYSTREAM_CACHE.get(key)
+    if keystreams is None:
+        keystreams = _compile_keystreams(schedule, length)
+        _KEYSTREAM_CACHE.put(key, keystreams)
+    return keystreams
+
+
+def _plan_phase_one(schedule, numbers, phase_one, profiler=None):
+    """Stages A to F of every cycle with the plan gathers."""
+    code_a = schedule.code_a
+    code_b = schedule.code_b
+    vigenere = _get_keystreams(schedule, numbers.shape[-1])[0]
+    for i, (first, second) in enumerate(phase_one):
+        if profiler:
+            profiler.start_cycle()
+        numbers = (numbers - vigenere[i]) % REFERENCE_LEN
+        if profiler:
+            profiler.lap("A", numbers)
+        numbers = numbers[..., first]
+        if profiler:
+            profiler.lap("B+C", numbers)
+        numbers = _chain_addition_numbers(numbers, code_b, code_a, i)
+        if profiler:
+            profiler.lap("D", numbers)
+        numbers = numbers[..., second]
+        if profiler:
+            profiler.lap("E+F", numbers)
+            profiler.end_cycle("phase one")
+    return numbers
+
+
+def _plan_phase_one_back(schedule, numbers, phase_one, profiler=None):
+    """Stages F to A of every cycle in reverse with the inverse gathers."""
+    code_a = schedule.code_a
+    code_b = schedule.code_b
+    cycle = schedule.cycle
+    vigenere = _get_keystreams(schedule, numbers.shape[-1])[0]
+    for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
+        first, second = phase_one[cycle - 1 - i]
+        numbers = numbers[..., second]
+        if profiler:
+            profiler.lap("E+F", numbers)
+        numbers = _chain_sub_numbers(numbers, code_b, code_a, i, cycle)
+        if profiler:
+            profiler.lap("D", numbers)
+        numbers = numbers[..., first]
+        if profiler:
+            profiler.lap("B+C", numbers)
+        numbers = (numbers + vigenere[cycle - 1 - i]) % REFERENCE_LEN
+        if profiler:
+            profiler.lap("A", numbers)
+            profiler.end_cycle("phase one")
+    return numbers
+
+
+def _run_phase_one(schedule, numbers, phase_one, affine, profiler,
+                   decrypt=False):
+    """
+    Runs phase one with the affine map if one is given, otherwise with
+    the plan gathers.
+    """
+    if affine is None:
+        run = _plan_phase_one_back if decrypt else _plan_phase_one
+        return run(schedule, numbers, phase_one, profiler)
+    if profiler:
+        profiler.start_cycle()
+    numbers = _apply_affine(numbers, affine)
+    if profiler:
+        profiler.lap("A-F", numbers)
+        profiler.end_cycle("phase one")
+    return numbers
+
+
+def _encrypt_plan_numbers(schedule, numbers, affine=False):
+    """
+    Stages A to R with the permutations gathered as per the plan.  Phase
+    one of short messages is run as one affine map if affine is true.
+    """
+    code_a = schedule.code_a
+    code_b = schedule.code_b
+    profiler = _active_profiler()
+    if profiler:
+        profiler.start()
+    phase_one, phase_two = _get_plan(schedule, numbers.shape[-1])
+    bellaso = _get_keystreams(schedule, numbers.shape[-1])[1]
+    affine = _get_affine(schedule, numbers.shape[-1]) if affine else None
+    if profiler:
+        profiler.lap("plan", numbers)
+
+    numbers = _run_phase_one(schedule, numbers, phase_one, affine, profiler)
+
+    letters = _to_letters(_add_two_random_numbers(numbers))
+    if profiler:
+        profiler.lap("G+H", letters)
+
+    for i, (first, second, third) in enumerate(phase_two):
+        if profiler:
+            profiler.start_cycle()
+        letters = letters[..., first]
+        if profiler:
+            profiler.lap("I+J", letters)
+        letters = _to_letters(_hill_numbers(_to_symbols(letters)))
+        if profiler:
+            profiler.lap("K", letters)
+        letters = letters[..., second]
+        if profiler:
+            profiler.lap("L+M", letters)
+        letters = _to_letters(_chain_addition_numbers(
+            _to_symbols(letters), code_a, code_b, i))
+        if profiler:
+            profiler.lap("N", letters)
+        letters = letters[..., third]
+        if profiler:
+            profiler.lap("O+P+Q", letters)
+        letters = _to_letters((_to_symbols(letters) + bellaso[i])
+                              % REFERENCE_LEN)
+        if profiler:
+            profiler.lap("R", letters)
+            profiler.end_cycle("phase two")
+    return letters
+
+
+def _decrypt_plan_numbers(schedule, letters, affine=False):
+    """
+    Stages R to A in reverse with the inverse plan gathers.  Phase one
+    of short messages is run as one affine map if affine is true.
+    """
+    code_a = schedule.code_a
+    code_b = schedule.code_b
+    cycle = schedule.cycle
+    _check_letter_count(letters.shape[-1])
+    length = letters.shape[-1] // 24 * 10
+    profiler = _active_profiler()
+    if profiler:
+        profiler.start()
+    phase_one, phase_two = _get_plan(schedule, length, True)
+    bellaso = _get_keystreams(schedule, length)[1]
+    affine = _get_affine(schedule, length, True) if affine else None
+    if profiler:
+        profiler.lap("plan", letters)
+
+    for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
+        first, second, third = phase_two[cycle - 1 - i]
+        letters = _to_letters((_to_symbols(letters) - bellaso[cycle - 1 - i])
+                              % REFERENCE_LEN)
+        if profiler:
+            profiler.lap("R", letters)
+        letters = letters[..., third]
+        if profiler:
+            profiler.lap("O+P+Q", letters)
+        letters = _to_letters(_chain_sub_numbers(
+            _to_symbols(letters), code_a, code_b, i, cycle))
+        if profiler:
+            profiler.lap("N", letters)
+        letters = letters[..., second]
+        if profiler:
+            profiler.lap("L+M", letters)
+        letters = _to_letters(_hill_numbers(_to_symbols(letters), True))
+        if profiler:
+            profiler.lap("K", letters)
+        letters = letters[..., first]
+        if profiler:
+            profiler.lap("I+J", letters)
+            profiler.end_cycle("phase two")
+
+    numbers = _remove_two_random_numbers(_to_symbols(letters))
+    if profiler:
+        profiler.lap("G+H", numbers)
+
+    return _run_phase_one(schedule, numbers, phase_one, affine, profiler,
+                          True)
+
+
+def _encrypt_plan(schedule, plaintext, rng=None):
+    """Encrypts the plaintext with the plan engine."""
+    return _encrypt_text(schedule, plaintext, _encrypt_plan_numbers, rng)
+
+
+def _decrypt_plan(schedule, ciphertext):
+    """Decrypts the ciphertext with the plan engine."""
+    return _decrypt_text(schedule, ciphertext, _decrypt_plan_numbers)
+
+
+# Every stage of phase one is affine over the integers modulo 49: A adds \
+# a constant, B, C, E and F permute the positions and D is a sum from each \
+# end plus constants.  So all the cycles of phase one make one affine map \
+# x -> x @ matrix + offset for each key schedule and message length.
+# Each key has a map for every padded length up to the limit in both \
+# directions, so the maps are kept up to a total number of bytes, enough \
+# for all the maps of several keys.
+_AFFINE_CACHE = _LRUCache(
+    32 * 1024 * 1024,
+    weigh=lambda affine: affine[0].nbytes + affine[1].nbytes)
+# The times each map was asked for before it was compiled.  A map costs \
+# up to a hundred runs of phase one to compile, so it is only compiled \
+# once its length is used again.
+_AFFINE_USES = _LRUCache(1024)
+# The matrix grows with the square of the length, so longer messages use \
+# the plan gathers, which are quicker than a dense product at that length
+_AFFINE_MAX_LENGTH = 200
+
+
+def set_affine_cache_size(size):
+    """Sets the most bytes of phase one affine maps kept."""
+    _AFFINE_CACHE.resize(size)
+
+
+def _compile_affine(schedule, length, decrypt=False):
+    """
+    Returns the matrix and offset of phase one, or of its inverse, for a
+    padded plaintext of the given length.
+    """
+    # The offset is the image of zero and each row of the matrix is the \
+    # image of a unit vector less the offset
+    basis = np.vstack([np.zeros(length, dtype=int),
+                       np.eye(length, dtype=int)])
+    phase_one = _get_plan(schedule, length, decrypt)[0]
+    run = _plan_phase_one_back if decrypt else _plan_phase_one
+    images = run(schedule, basis, phase_one)
+    offset = images[0]
+    matrix = (images[1:] - offset) % REFERENCE_LEN
+    # The products are below 2 ** 53, so they are exact as floats and can \
+    # use the fast matrix product
+    return matrix.astype(float), offset
+
+
+def _get_affine(schedule, length, decrypt=False):
+    """
+    Returns the phase one affine map, compiling it if not cached, or None
+    if the message is too long or its length has not been used before.
+    """
+    if length > _AFFINE_MAX_LENGTH:
+        return None
+    key = (schedule, length, decrypt)
+    affine = _AFFINE_CACHE.get(key)
+    if affine is None:
+        if _AFFINE_USES.get(key) is None:
+            _AFFINE_USES.put(key, True)
+            return None
+        affine = _compile_affine(schedule, length, decrypt)
+        _AFFINE_CACHE.put(key, affine)
+    return affine
+
+
+def _apply_affine(numbers, affine):
+    """Applies the affine map to the numbers, or to each row of a batch."""
+    matrix, offset = affine
+    return (np.rint(numbers @ matrix).astype(int) + offset) % REFERENCE_LEN
+
+
+def _encrypt_affine_numbers(schedule, numbers):
+    """Stages A to R with phase one as one affine map."""
+    return _encrypt_plan_numbers(schedule, numbers, True)
+
+
+def _decrypt_affine_numbers(schedule, letters):
+    """Stages R to A with phase one as one affine map."""
+    return _decrypt_plan_numbers(schedule, letters, True)
+
+
+def _encrypt_affine(schedule, plaintext, rng=None):
+    """Encrypts the plaintext with the affine engine."""
+    return _encrypt_text(schedule, plaintext, _encrypt_affine_numbers, rng)
+
+
+def _decrypt_affine(schedule, ciphertext):
+    """Decrypts the ciphertext with the affine engine."""
+    return _decrypt_text(schedule, ciphertext, _decrypt_affine_numbers)
+
+
+# The scratch engine runs the plan engine stages without allocating an \
+# output for each stage.  Each message, or batch, gets two buffers of each \
+# shape and every gather and sum writes from one buffer into the other or \
+# in place, so the buffers are only allocated once per call.
+
+
+def _scratch_letters(symbols, letters):
+    """Writes the pairs of code letter numbers of the symbols to letters."""
+    np.take(SYMBOL_LETTERS, symbols, axis=0, mode="clip",
+            out=letters.reshape(symbols.shape + (2,)))
+
+
+def _scratch_symbols(letters, symbols):
+    """Writes the reference numbers of the pairs of letters to symbols."""
+    pairs = letters.reshape(symbols.shape + (2,))
+    np.multiply(pairs[..., 0], len(CODE_LETTER), out=symbols)
+    np.add(symbols, pairs[..., 1], out=symbols)
+    # Each position only reads its own index, so the lookup can be in place
+    np.take(LETTER_SYMBOLS.reshape(-1), symbols, mode="clip", out=symbols)
+
+
+def _scratch_hill(symbols, out, decrypt=False):
+    """Writes the Hill products of the blocks of four symbols to out."""
+    hill_matrix = HILL_MATRIX_INV if decrypt else HILL_MATRIX
+    shape = symbols.shape[:-1] + (-1, 4)
+    np.matmul(symbols.reshape(shape), hill_matrix.T, out=out.reshape(shape))
+    np.remainder(out, REFERENCE_LEN, out=out)
+
+
+def _scratch_chain_addition(numbers, scratch, code_a, code_b, i):
+    """Chain addition of the numbers in place, summing into scratch."""
+    np.cumsum(numbers, axis=-1, out=scratch)
+    np.add(scratch, code_a[i % len(code_a)] + 1, out=scratch)
+    np.remainder(scratch, REFERENCE_LEN, out=scratch)
+    # The sums from the end are written through reversed views
+    np.cumsum(scratch[..., ::-1], axis=-1, out=numbers[..., ::-1])
+    np.add(numbers, code_b[i % len(code_b)], out=numbers)
+    np.remainder(numbers, REFERENCE_LEN, out=numbers)
+
+
+def _scratch_chain_sub(numbers, scratch, code_a, code_b, i, cycle):
+    """Reverses the chain addition of the numbers in place."""
+    # An empty message has no last number to subtract the code from
+    if not numbers.shape[-1]:
+        return
+    i = cycle - 1 - i
+    np.subtract(numbers[..., :-1], numbers[..., 1:], out=scratch[..., :-1])
+    np.subtract(numbers[..., -1], code_b[i % len(code_b)],
+                out=scratch[..., -1])
+    np.remainder(scratch, REFERENCE_LEN, out=scratch)
+    np.subtract(scratch[..., 1:], scratch[..., :-1], out=numbers[..., 1:])
+    np.subtract(scratch[..., 0], code_a[i % len(code_a)] + 1,
+                out=numbers[..., 0])
+    np.remainder(numbers, REFERENCE_LEN, out=numbers)
+
+
+def _encrypt_scratch_numbers(schedule, numbers):
+    """Stages A to R as per the plan, in two buffers of each shape."""
+    code_a = schedule.code_a
+    code_b = schedule.code_b
+    length = numbers.shape[-1]
+    rows = numbers.shape[:-1]
+    profiler = _active_profiler()
+    if profiler:
+        profiler.start()
+    phase_one, phase_two = _get_plan(schedule, length)
+    vigenere, bellaso = _get_keystreams(schedule, length)
+    numbers = np.array(numbers, dtype=int)
+    spare = np.empty_like(numbers)
+    if profiler:
+        profiler.lap("plan", numbers)
+
+    for i, (first, second) in enumerate(phase_one):
+        if profiler:
+            profiler.start_cycle()
+        np.subtract(numbers, vigenere[i], out=numbers)
+        np.remainder(numbers, REFERENCE_LEN, out=numbers)
+        if profiler:
+            profiler.lap("A", numbers)
+        np.take(numbers, first, axis=-1, mode="clip", out=spare)
+        if profiler:
+            profiler.lap("B+C", spare)
+        _scratch_chain_addition(spare, numbers, code_b, code_a, i)
+        if profiler:
+            profiler.lap("D", spare)
+        np.take(spare, second, axis=-1, mode="clip", out=numbers)
+        if profiler:
+            profiler.lap("E+F", numbers)
+            profiler.end_cycle("phase one")
+
+    # The ^ symbols added for every 10 numbers are zero
+    symbols = np.zeros(rows + (length // 10 * 12,), dtype=int)
+    spare_symbols = np.empty_like(symbols)
+    letters = np.empty(rows + (length // 10 * 24,), dtype=int)
+    spare_letters = np.empty_like(letters)
+    np.copyto(symbols.reshape(rows + (-1, 12))[..., 1:11],
+              numbers.reshape(rows + (-1, 10)))
+    _scratch_letters(symbols, letters)
+    if profiler:
+        profiler.lap("G+H", letters)
+
+    for i, (first, second, third) in enumerate(phase_two):
+        if profiler:
+            profiler.start_cycle()
+        np.take(letters, first, axis=-1, mode="clip", out=spare_letters)
+        if profiler:
+            profiler.lap("I+J", spare_letters)
+        _scratch_symbols(spare_letters, symbols)
+        _scratch_hill(symbols, spare_symbols)
+        _scratch_letters(spare_symbols, letters)
+        if profiler:
+            profiler.lap("K", letters)
+        np.take(letters, second, axis=-1, mode="clip", out=spare_letters)
+        if profiler:
+            profiler.lap("L+M", spare_letters)
+        _scratch_symbols(spare_letters, symbols)
+        _scratch_chain_addition(symbols, spare_symbols, code_a, code_b, i)
+        _scratch_letters(symbols, letters)
+        if profiler:
+            profiler.lap("N", letters)
+        np.take(letters, third, axis=-1, mode="clip", out=spare_letters)
+        if profiler:
+            profiler.lap("O+P+Q", spare_letters)
+        _scratch_symbols(spare_letters, symbols)
+        np.add(symbols, bellaso[i], out=symbols)
+        np.remainder(symbols, REFERENCE_LEN, out=symbols)
+        _scratch_letters(symbols, letters)
+        if profiler:
+            profiler.lap("R", letters)
+            profiler.end_cycle("phase two")
+    return letters
+
+
+def _decrypt_scratch_numbers(schedule, letters):
+    """Stages R to A in reverse as per the plan, in two buffers each."""
+    code_a = schedule.code_a
+    code_b = schedule.code_b
+    cycle = schedule.cycle
+    _check_letter_count(letters.shape[-1])
+    length = letters.shape[-1] // 24 * 10
+    rows = letters.shape[:-1]
+    profiler = _active_profiler()
+    if profiler:
+        profiler.start()
+    phase_one, phase_two = _get_plan(schedule, length, True)
+    vigenere, bellaso = _get_keystreams(schedule, length)
+    letters = np.array(letters, dtype=int)
+    spare_letters = np.empty_like(letters)
+    symbols = np.empty(rows + (length // 10 * 12,), dtype=int)
+    spare_symbols = np.empty_like(symbols)
+    if profiler:
+        profiler.lap("plan", letters)
+
+    for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
+        first, second, third = phase_two[cycle - 1 - i]
+        _scratch_symbols(letters, symbols)
+        np.subtract(symbols, bellaso[cycle - 1 - i], out=symbols)
+        np.remainder(symbols, REFERENCE_LEN, out=symbols)
+        _scratch_letters(symbols, spare_letters)
+        if profiler:
+            profiler.lap("R", spare_letters)
+        np.take(spare_letters, third, axis=-1, mode="clip", out=letters)
+        if profiler:
+            profiler.lap("O+P+Q", letters)
+        _scratch_symbols(letters, symbols)
+        _scratch_chain_sub(symbols, spare_symbols, code_a, code_b, i, cycle)
+        _scratch_letters(symbols, spare_letters)
+        if profiler:
+            profiler.lap("N", spare_letters)
+        np.take(spare_letters, second, axis=-1, mode="clip", out=letters)
+        if profiler:
+            profiler.lap("L+M", letters)
+        _scratch_symbols(letters, symbols)
+        _scratch_hill(symbols, spare_symbols, True)
+        _scratch_letters(spare_symbols, spare_letters)
+        if profiler:
+            profiler.lap("K", spare_letters)
+        np.take(spare_letters, first, axis=-1, mode="clip", out=letters)
+        if profiler:
+            profiler.lap("I+J", letters)
+            profiler.end_cycle("phase two")
+
+    _scratch_symbols(letters, symbols)
+    numbers = np.empty(rows + (length,), dtype=int)
+    spare = np.empty_like(numbers)
+    np.copyto(numbers.reshape(rows + (-1, 10)),
+              symbols.reshape(rows + (-1, 12))[..., 1:11])
+    if profiler:
+        profiler.lap("G+H", numbers)
+
+    for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
+        first, second = phase_one[cycle - 1 - i]
+        np.take(numbers, second, axis=-1, mode="clip", out=spare)
+        if profiler:
+            profiler.lap("E+F", spare)
+        _scratch_chain_sub(spare, numbers, code_b, code_a, i, cycle)
+        if profiler:
+            profiler.lap("D", spare)
+        np.take(spare, first, axis=-1, mode="clip", out=numbers)
+        if profiler:
+            profiler.lap("B+C", numbers)
+        np.add(numbers, vigenere[cycle - 1 - i], out=numbers)
+        np.remainder(numbers, REFERENCE_LEN, out=numbers)
+        if profiler:
+            profiler.lap("A", numbers)
+            profiler.end_cycle("phase one")
+    return numbers
+
+
+def _encrypt_scratch(schedule, plaintext, rng=None):
+    """Encrypts the plaintext with the scratch engine."""
+    return _encrypt_text(schedule, plaintext, _encrypt_scratch_numbers, rng)
+
+
+def _decrypt_scratch(schedule, ciphertext):
+    """Decrypts the ciphertext with the scratch engine."""
+    return _decrypt_text(schedule, ciphertext, _decrypt_scratch_numbers)
+
+
+# Profiling is opt in.  The stages only check whether a profiler is \
+# active in the current thread, so there is no other cost when disabled.
+_PROFILING = local()
+
+
+def _active_profiler():
+    """Returns the profiler active in this thread or None."""
+    return getattr(_PROFILING, "profiler", None)
+
+
+class StageProfiler:
+    """
+    Collects the number of calls, the total time and the symbols
+    produced by each lettered stage and each cycle of encrypt and
+    decrypt.  A symbol is a character of a string or an element of an
+    array, so every engine reports the same counts.  It is active for the
+    calls made in the same thread inside the with block.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.cycles = {}
+        self._last = self._cycle_start = perf_counter()
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = _active_profiler()
+        _PROFILING.profiler = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _PROFILING.profiler = self._previous
+
+    def start(self):
+        """Marks the start of the stages of one call."""
+        self._last = perf_counter()
+
+    def lap(self, stage, data):
+        """
+        Records the time since the last stage and the output size, given
+        as the output or as a number of characters.
+        """
+        now = perf_counter()
+        if isinstance(data, np.ndarray):
+            size = data.size
+        elif isinstance(data, int):
+            size = data
+        else:
+            size = len(data)
+        _add_timing(self.stages, stage, now - self._last, size)
+        self._last = now
+
+    def start_cycle(self):
+        """Marks the start of a cycle."""
+        self._cycle_start = perf_counter()
+
+    def end_cycle(self, phase):
+        """Records the time of the cycle against the phase."""
+        self._last = perf_counter()
+        _add_timing(self.cycles, phase, self._last - self._cycle_start, 0)
+
+    def as_dict(self):
+        """Returns the timings as a dictionary."""
+        def entries(timings):
+            return {name: {"calls": calls, "seconds": seconds,
+                           "symbols": size}
+                    for name, (calls, seconds, size) in timings.items()}
+        return {"stages": entries(self.stages), "cycles": entries(self.cycles)}
+
+    def to_json(self, **kwargs):
+        """Returns the timings as JSON."""
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def report(self):
+        """Returns the timings as a text table."""
+        rows = [["stage", "calls", "total ms", "mean us", "symbols"]]
+        for timings in (self.stages, self.cycles):
+            for name, (calls, seconds, size) in timings.items():
+                rows.append([name, str(calls), f"{seconds * 1e3:.3f}",
+                             f"{seconds * 1e6 / calls:.1f}", str(size)])
+        widths = [max(len(row[k]) for row in rows) for k in range(5)]
+        return "\n".join("  ".join(cell.rjust(width)
+                                   for cell, width in zip(row, widths))
+                         for row in rows)
+
+
+def _add_timing(timings, name, seconds, size):
+    """Adds one call to the timings of the name."""
+    calls, total, total_size = timings.get(name, (0, 0.0, 0))
+    timings[name] = (calls + 1, total + seconds, total_size + size)
+
+
+class MemoryProfiler(StageProfiler):
+    """
+    A stage profiler which also traces the memory allocated with
+    tracemalloc.  Each encrypt and decrypt of a key schedule records its
+    peak bytes above the memory in use when it was called and its total
+    bytes allocated, taken as the sum of the rise to the peak of each
+    stage.  Tracing slows the stages, so the times are only comparable
+    between runs which are also traced.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.memory = {}
+        self.calls = {}
+        self._tracing = False
+        self._level = self._base = self._peak = self._allocated = 0
+
+    def __enter__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self._level = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def _trace(self):
+        """
+        Returns the bytes allocated since the last trace and restarts the
+        peak from the memory now in use.
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        allocated = max(peak - self._level, 0)
+        self._peak = max(self._peak, peak - self._base)
+        self._allocated += allocated
+        tracemalloc.reset_peak()
+        self._level = current
+        return allocated
+
+    def lap(self, stage, data):
+        """Records the time, output size and allocations of the stage."""
+        super().lap(stage, data)
+        allocated = self._trace()
+        _add_memory(self.memory, stage, allocated, allocated)
+
+    def measure(self, name, function, *args):
+        """Calls the function, recording its memory against the name."""
+        self._trace()
+        self._base = self._level
+        self._peak = self._allocated = 0
+        try:
+            return function(*args)
+        finally:
+            self._trace()
+            _add_memory(self.calls, name, self._allocated, self._peak)
+
+    def as_dict(self):
+        """Returns the timings and the memory as a dictionary."""
+        def entries(memory):
+            return {name: {"calls": calls, "allocated": allocated,
+                           "peak": peak}
+                    for name, (calls, allocated, peak) in memory.items()}
+        result = super().as_dict()
+        result["memory"] = entries(self.memory)
+        result["calls"] = entries(self.calls)
+        return result
+
+    def report(self):
+        """Returns the timings and the memory as text tables."""
+        rows = [["memory", "calls", "peak bytes", "allocated bytes",
+                 "mean allocated"]]
+        for memory in (self.calls, self.memory):
+            for name, (calls, allocated, peak) in memory.items():
+                rows.append([name, str(calls), str(peak), str(allocated),
+                             str(allocated // calls)])
+        widths = [max(len(row[k]) for row in rows) for k in range(5)]
+        return super().report() + "\n\n" + "\n".join(
+            "  ".join(cell.rjust(width) for cell, width in zip(row, widths))
+            for row in rows)
+
+
+def _add_memory(memory, name, allocated, peak):
+    """Adds one call to the allocations of the name."""
+    calls, total, largest = memory.get(name, (0, 0, 0))
+    memory[name] = (calls + 1, total + allocated, max(largest, peak))
+
+
+def _measured(name, function, *args):
+    """Calls the function, measured if a memory profiler is active."""
+    profiler = _active_profiler()
+    if isinstance(profiler, MemoryProfiler):
+        return profiler.measure(name, function, *args)
+    return function(*args)
+
+
+# Serialised key schedules start with a magic number and format version
+_SCHEDULE_MAGIC = b"SPKS"
+_SCHEDULE_VERSION = 1
+
+
+class KeySchedule:
+    """
+    The code lists and code orders derived from the three pass codes.
+    Deriving these is the costly part of the set up so a key schedule
+    is built once and reused for every message under the same codes.
+    """
+
+    def __init__(self, codes):
+        code1, code2, code3 = codes
+        profiler = _active_profiler()
+        if profiler:
+            profiler.start()
+        self.codes = tuple(codes)
+        self.code_reference, self.code_order5, self.code_order6, \
+        self.code_order24, self.code_a, self.code_b, self.code_order5_inv, \
+        self.code_order6_inv, self.code_order24_inv, \
+        self.extra_cycle = _rearrangement(code1, code2, code3)
+        if profiler:
+            profiler.lap("key schedule", code1 + code2 + code3)
+        # The cycle number is varailbe with a numer between 12 and 60
+        # The cycle number is variable so that thelst last code reference \
+        # used in the cipher is not known
+        self.cycle = 12 + self.extra_cycle
+
+    # The lists stored by to_bytes, each as a count of rows followed by \
+    # the length and numbers of each row
+    _FIELDS = ("code_reference", "code_order5", "code_order6",
+               "code_order24", "code_order5_inv", "code_order6_inv",
+               "code_order24_inv")
+
+    def to_bytes(self):
+        """
+        Returns the key schedule as bytes: a header and version, the
+        numbers of every list and a CRC-32 checksum.  The pass codes are
+        not stored, but the bytes decrypt messages just as the codes do.
+        """
+        data = array("B", _SCHEDULE_MAGIC)
+        data.append(_SCHEDULE_VERSION)
+        for rows in [getattr(self, field) for field in self._FIELDS] + \
+                [[self.code_a, self.code_b]]:
+            data.append(len(rows))
+            for row in rows:
+                data.append(len(row))
+                data.extend(row)
+        data.append(self.extra_cycle)
+        data.extend(zlib.crc32(data).to_bytes(4, "big"))
+        return data.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Returns the key schedule stored by to_bytes."""
+        data = bytes(data)
+        if data[:4] != _SCHEDULE_MAGIC:
+            raise ValueError("Not a key schedule.")
+        if data[4:5] != bytes([_SCHEDULE_VERSION]):
+            raise ValueError("Unsupported key schedule version.")
+        if len(data) < 9 or \
+                zlib.crc32(data[:-4]).to_bytes(4, "big") != data[-4:]:
+            raise ValueError("The key schedule is corrupted.")
+        schedule = cls.__new__(cls)
+        schedule.codes = None
+        fields = []
+        position = 5
+        try:
+            for _ in range(len(cls._FIELDS) + 1):
+                rows = []
+                for _ in range(data[position]):
+                    length = data[position + 1]
+                    rows.append(list(data[position + 2:
+                                          position + 2 + length]))
+                    position += length + 1
+                fields.append(rows)
+                position += 1
+            schedule.extra_cycle = data[position]
+        except IndexError:
+            raise ValueError("The key schedule is corrupted.") from None
+        if position + 5 != len(data):
+            raise ValueError("The key schedule is corrupted.")
+        for field, rows in zip(cls._FIELDS, fields):
+            setattr(schedule, field, rows)
+        schedule.code_a, schedule.code_b = fields[-1]
+        schedule.cycle = 12 + schedule.extra_cycle
+        return schedule
+
+    def encrypt(self, plaintext, engine="reference", rng=None):
+        """Encrypts the given plaintext with this key schedule."""
+        return _measured("encrypt", _get_engine(engine)[0], self, plaintext,
+                         rng)
+
+    def decrypt(self, ciphertext, engine="reference"):
+        """Decrypts the given ciphertext with this key schedule."""
+        return _measured("decrypt", _get_engine(engine)[1], self,
+                         ciphertext)
+
+    def encrypt_many(self, plaintexts, engine="plan", batch_size=1024,
+                     rng=None):
+        """Encrypts many plaintexts, returning the ciphertexts in order."""
+        return _measured("encrypt_many", _encrypt_batch, self, plaintexts,
+                         engine, batch_size, rng)
+
+    def decrypt_many(self, ciphertexts, engine="plan", batch_size=1024):
+        """Decrypts many ciphertexts, returning the plaintexts in order."""
+        return _measured("decrypt_many", _decrypt_batch, self, ciphertexts,
+                         engine, batch_size)
+
+
+# Key schedules are kept in a least recently used cache keyed on the codes
+_SCHEDULE_CACHE = _LRUCache(32)
+
+
+def set_schedule_cache_size(size):
+    """Sets the number of key schedules kept and evicts any extra ones."""
+    _SCHEDULE_CACHE.resize(size)
+
+
+def clear_schedule_cache():
+    """Removes all cached key schedules."""
+    _SCHEDULE_CACHE.clear()
+
+
+def _forget_schedule(schedule):
+    """Removes the cached plans, keystreams and affine maps of a schedule."""
+    for cache in (_PLAN_CACHE, _KEYSTREAM_CACHE, _AFFINE_CACHE,
+                  _AFFINE_USES):
+        cache.discard(lambda key: key[0] is schedule)
+
+
+def get_key_schedule(codes):
+    """Returns the key schedule for the codes, deriving it if not cached."""
+    if isinstance(codes, KeySchedule):
+        return codes
+    key = tuple(codes)
+    schedule = _SCHEDULE_CACHE.get(key)
+    if schedule is None:
+        # The derivation is done outside the lock so other keys are not \
+        # blocked while the schedule is derived
+        schedule = KeySchedule(key)
+        _SCHEDULE_CACHE.put(key, schedule)
+    return schedule
+
+
+def save_key_schedule(schedule, path):
+    """
+    Saves the key schedule of the codes to the file.  The file can only
+    be read by its owner, as it is as secret as the pass codes.
+    """
+    data = get_key_schedule(schedule).to_bytes()
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(descriptor, "wb") as file:
+        # An existing file keeps its mode, so it is set again
+        if hasattr(os, "fchmod"):
+            os.fchmod(descriptor, 0o600)
+        file.write(data)
+
+
+def load_key_schedule(path):
+    """
+    Loads a key schedule saved by save_key_schedule.  Raises ValueError
+    if other users can read the file or it is corrupted.
+    """
+    with open(path, "rb") as file:
+        if os.name == "posix" and os.fstat(file.fileno()).st_mode & 0o077:
+            raise ValueError("The key schedule file can be accessed by "
+                             "other users.")
+        return KeySchedule.from_bytes(file.read())
+
+
+def _get_engine(engine):
+    """Returns the encrypt and decrypt functions of the named engine."""
+    try:
+        return ENGINES[engine]
+    except KeyError:
+        raise ValueError(f"Unknown engine {engine!r}.") from None
+
+
+def encrypt(codes, plaintext, engine="reference", rng=None):
+    """
+    Encrypts the given plaintext with the given codes.  The random
+    letters are taken from rng.choice if a rng is given.
+    """
+    return get_key_schedule(codes).encrypt(plaintext, engine, rng)
+
+
+def decrypt(codes, ciphertext, engine="reference"):
+    """Decrypts the given ciphertext with the given codes."""
+    return get_key_schedule(codes).decrypt(ciphertext, engine)
+
+
+def encrypt_many(codes, plaintexts, engine="plan", batch_size=1024,
+                 rng=None):
+    """Encrypts many plaintexts with the same codes."""
+    return get_key_schedule(codes).encrypt_many(plaintexts, engine,
+                                                batch_size, rng)
+
+
+def decrypt_many(codes, ciphertexts, engine="plan", batch_size=1024):
+    """Decrypts many ciphertexts with the same codes."""
+    return get_key_schedule(codes).decrypt_many(ciphertexts, engine,
+                                                batch_size)
+
+
+def encrypt_into(codes, plaintext, out, engine="plan", rng=None):
+    """
+    Encrypts the plaintext and writes the ciphertext as ASCII into the
+    start of the writable buffer out.  Returns the number of bytes.
+    """
+    encrypt_numbers = _get_number_engine(engine)[0]
+    return _encrypt_text(get_key_schedule(codes), plaintext, encrypt_numbers,
+                         rng, out)
+
+
+def decrypt_into(codes, ciphertext, out, engine="plan"):
+    """
+    Decrypts the ciphertext and writes the plaintext as ASCII into the
+    start of the writable buffer out.  Returns the number of bytes.
+    """
+    decrypt_numbers = _get_number_engine(engine)[1]
+    return _decrypt_text(get_key_schedule(codes), ciphertext,
+                         decrypt_numbers, out)
+
+
+def _get_number_engine(engine):
+    """Returns the array functions of the named engine for batches."""
+    try:
+        return NUMBER_ENGINES[engine]
+    except KeyError:
+        raise ValueError(f"Engine {engine!r} cannot process batches.") \
+            from None
+
+
+def _run_batches(texts, process, batch_size):
+    """
+    Groups the texts by length, stacks each group into 2D arrays of up to
+    batch_size rows, processes them and returns the rows in input order.
+    """
+    if batch_size < 1:
+        raise ValueError("The batch size must be at least 1.")
+    groups = {}
+    for position, text in enumerate(texts):
+        groups.setdefault(len(text), []).append(position)
+    results = [None] * len(texts)
+    for length, positions in groups.items():
+        for start in range(0, len(positions), batch_size):
+            batch = positions[start:start + batch_size]
+            rows = process([texts[position] for position in batch], length)
+            for position, row in zip(batch, rows):
+                results[position] = row
+    return results
+
+
+def _encrypt_batch(schedule, plaintexts, engine="plan", batch_size=1024,
+                   rng=None):
+    """Encrypts the plaintexts in 2D batches of equal padded length."""
+    encrypt_numbers = _get_number_engine(engine)[0]
+    # The random letters are added in the input order
+    texts = [_add_random(_substitute(plaintext.upper()), rng)
+             for plaintext in plaintexts]
+
+    def process(batch, length):
+        numbers = np.empty((len(batch), length), dtype=int)
+        for row, text in enumerate(batch):
+            numbers[row] = _text_to_numbers(text)
+        letters = encrypt_numbers(schedule, numbers)
+        return [_adds_spaces(_letters_to_text(row)) for row in letters]
+
+    return _run_batches(texts, process, batch_size)
+
+
+def _decrypt_batch(schedule, ciphertexts, engine="plan", batch_size=1024):
+    """Decrypts the ciphertexts in 2D batches of equal length."""
+    decrypt_numbers = _get_number_engine(engine)[1]
+    texts = [_substitute(ciphertext, spaces=False)
+             for ciphertext in ciphertexts]
+
+    def process(batch, length):
+        letters = np.empty((len(batch), length), dtype=int)
+        for row, text in enumerate(batch):
+            letters[row] = _text_to_letters(text)
+        numbers = decrypt_numbers(schedule, letters)
+        return [_reinstate_space(_numbers_to_text(row)) for row in numbers]
+
+    return _run_batches(texts, process, batch_size)
+
+
+# Each worker process receives the key schedule once when it starts, so \
+# the tasks only carry the messages
+_worker_schedule = None
+_worker_engine = None
+
+
+def _init_worker(schedule, engine):
+    """Stores the key schedule and engine in the worker process."""
+    global _worker_schedule, _worker_engine
+    _worker_schedule = schedule
+    _worker_engine = engine
+
+
+def _encrypt_chunk(plaintexts):
+    """Encrypts a chunk of plaintexts in a worker process."""
+    return _encrypt_batch(_worker_schedule, plaintexts, _worker_engine)
+
+
+def _decrypt_chunk(ciphertexts):
+    """Decrypts a chunk of ciphertexts in a worker process."""
+    return _decrypt_batch(_worker_schedule, ciphertexts, _worker_engine)
+
+
+class ParallelCipher:
+    """
+    Encrypts and decrypts many messages under one key across a pool of
+    worker processes.  The messages are sent in chunks and the results
+    come back in the input order.
+    """
+
+    def __init__(self, codes, workers=None, chunk_size=256, engine="plan"):
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be at least 1.")
+        _get_number_engine(engine)
+        self.schedule = get_key_schedule(codes)
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count() or 1
+        from concurrent.futures import ProcessPoolExecutor
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker,
+            initargs=(self.schedule, engine))
+        # Limits the chunks in flight so that the input is read lazily
+        self._max_pending = 2 * self.workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shuts down the worker processes."""
+        self._executor.shutdown()
+
+    def encrypt(self, plaintexts):
+        """Encrypts the plaintexts and returns a list of ciphertexts."""
+        return list(self.imap_encrypt(plaintexts))
+
+    def decrypt(self, ciphertexts):
+        """Decrypts the ciphertexts and returns a list of plaintexts."""
+        return list(self.imap_decrypt(ciphertexts))
+
+    def imap_encrypt(self, plaintexts):
+        """Yields the ciphertexts in order while the rest are encrypted."""
+        return self._imap(_encrypt_chunk, plaintexts)
+
+    def imap_decrypt(self, ciphertexts):
+        """Yields the plaintexts in order while the rest are decrypted."""
+        return self._imap(_decrypt_chunk, ciphertexts)
+
+    def _imap(self, function, messages):
+        pending = deque()
+        messages = iter(messages)
+        while True:
+            chunk = list(islice(messages, self.chunk_size))
+            if not chunk:
+                break
+            pending.append(self._executor.submit(function, chunk))
+            if len(pending) >= self._max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def encrypt_parallel(codes, plaintexts, workers=None, chunk_size=256):
+    """Encrypts many plaintexts with the same codes across processes."""
+    with ParallelCipher(codes, workers, chunk_size) as cipher:
+        return cipher.encrypt(plaintexts)
+
+
+def decrypt_parallel(codes, ciphertexts, workers=None, chunk_size=256):
+    """Decrypts many ciphertexts with the same codes across processes."""
+    with ParallelCipher(codes, workers, chunk_size) as cipher:
+        return cipher.decrypt(ciphertexts)
+
+
+async def aencrypt(codes, plaintext, engine="plan", rng=None,
+                   executor=None):
+    """
+    Encrypts in the executor, or the default thread pool of the event
+    loop, so that long messages do not block the event loop.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, encrypt, codes, plaintext,
+                                      engine, rng)
+
+
+async def adecrypt(codes, ciphertext, engine="plan", executor=None):
+    """Decrypts in the executor without blocking the event loop."""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, decrypt, codes, ciphertext,
+                                      engine)
+
+
+def _service_batch(encrypting, codes, texts, engine):
+    """Runs one batch of AsyncCipherService in a thread or process."""
+    # Each process keeps its own cache of key schedules
+    schedule = get_key_schedule(codes)
+    if encrypting:
+        return schedule.encrypt_many(texts, engine)
+    return schedule.decrypt_many(texts, engine)
+
+
+class AsyncCipherService:
+    """
+    Encrypts and decrypts for asyncio code in a thread or process pool.
+    Requests wait in a bounded queue, so callers are held back when the
+    pool falls behind, and the waiting requests for the same codes are
+    run together as one batch.
+    """
+
+    def __init__(self, executor="thread", workers=None, max_queue=1024,
+                 max_batch=256, engine="plan"):
+        if executor not in ("thread", "process"):
+            raise ValueError("The executor should be 'thread' or "
+                             "'process'.")
+        if max_queue < 1 or max_batch < 1:
+            raise ValueError("The queue and batch sizes must be at least 1.")
+        _get_number_engine(engine)
+        self.engine = engine
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.workers = workers or os.cpu_count() or 1
+        from concurrent.futures import ProcessPoolExecutor, \
+            ThreadPoolExecutor
+        pool = ThreadPoolExecutor if executor == "thread" \
+            else ProcessPoolExecutor
+        self._executor = pool(max_workers=self.workers)
+        self._processes = executor == "process"
+        # The queue is created when the service starts so that it belongs \
+        # to the running event loop
+        self._queue = None
+        self._slots = None
+        self._dispatcher = None
+        self._running = set()
+        self.requests = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self._latencies = deque(maxlen=1000)
+
+    async def __aenter__(self):
+        self._start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _start(self):
+        import asyncio
+        if self._dispatcher is None:
+            self._queue = asyncio.Queue(self.max_queue)
+            # Each slot is one drained set of requests in the pool
+            self._slots = asyncio.Semaphore(self.workers)
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def close(self):
+        """Finishes the waiting requests and shuts down the pool."""
+        import asyncio
+        if self._dispatcher is not None:
+            await self._queue.join()
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        self._executor.shutdown()
+
+    async def encrypt(self, codes, plaintext):
+        """Encrypts the plaintext, waiting if the queue is full."""
+        return await self._submit(True, codes, plaintext)
+
+    async def decrypt(self, codes, ciphertext):
+        """Decrypts the ciphertext, waiting if the queue is full."""
+        return await self._submit(False, codes, ciphertext)
+
+    def metrics(self):
+        """Returns the request counts, queue depths and latencies."""
+        latencies = sorted(self._latencies)
+        count = len(latencies)
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches
+                               if self.batches else 0.0,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "running": len(self._running),
+            "latency_mean": sum(latencies) / count if count else 0.0,
+            "latency_p95": latencies[int(0.95 * (count - 1))]
+                           if count else 0.0,
+            "latency_max": latencies[-1] if count else 0.0,
+        }
+
+    async def _submit(self, encrypting, codes, text):
+        import asyncio
+        self._start()
+        # Key schedules are sent to processes as their codes, which are \
+        # quicker to pickle
+        if not isinstance(codes, KeySchedule):
+            codes = tuple(codes)
+        elif self._processes and codes.codes is not None:
+            codes = codes.codes
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((encrypting, codes, text, future,
+                               perf_counter()))
+        self.max_queue_depth = max(self.max_queue_depth,
+                                   self._queue.qsize())
+        return await future
+
+    async def _dispatch(self):
+        import asyncio
+        while True:
+            await self._slots.acquire()
+            requests = [await self._queue.get()]
+            while len(requests) < self.max_batch and not self._queue.empty():
+                requests.append(self._queue.get_nowait())
+            task = asyncio.create_task(self._run(requests))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, requests):
+        import asyncio
+        groups = {}
+        for request in requests:
+            groups.setdefault(request[:2], []).append(request)
+        try:
+            await asyncio.gather(*[self._run_group(*key, group)
+                                   for key, group in groups.items()])
+        finally:
+            self._slots.release()
+            for _ in requests:
+                self._queue.task_done()
+
+    async def _run_group(self, encrypting, codes, group):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self._executor, _service_batch, encrypting, codes,
+                [request[2] for request in group], self.engine)
+        except Exception as error:
+            if len(group) == 1:
+                self._finish(group[0], error=error)
+                return
+            # One invalid message fails the whole batch, so the messages \
+            # are run again one at a time
+            for request in group:
+                await self._run_group(encrypting, codes, [request])
+            return
+        self.batches += 1
+        for request, result in zip(group, results):
+            self._finish(request, result)
+
+    def _finish(self, request, result=None, error=None):
+        future = request[3]
+        self.requests += 1
+        self._latencies.append(perf_counter() - request[4])
+        if future.done():
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+
+# Messages between CipherServer and CipherClient are a 4 byte big endian \
+# length followed by that many bytes of JSON.  Requests are objects with \
+# "op" and, to encrypt or decrypt, "codes" and "text" or a list of "texts"
+_MAX_MESSAGE = 64 * 1024 * 1024
+
+
+def _pack_message(message):
+    """Returns the message as a length prefixed JSON frame."""
+    data = json.dumps(message).encode("utf-8")
+    if len(data) > _MAX_MESSAGE:
+        raise ValueError("The message is too long.")
+    return len(data).to_bytes(4, "big") + data
+
+
+def _unpack_length(header):
+    """Returns the length of the frame from its header."""
+    length = int.from_bytes(header, "big")
+    if length > _MAX_MESSAGE:
+        raise ValueError("The message is too long.")
+    return length
+
+
+class CipherServer:
+    """
+    A local server which keeps the key schedules of recent codes and
+    encrypts and decrypts requests from many clients at once.  The
+    address is the path of a Unix socket or a (host, port) pair.
+    """
+
+    def __init__(self, address, workers=None, cache_size=128, ttl=600,
+                 engine="plan"):
+        if not isinstance(address, str) and \
+                address[0] not in ("127.0.0.1", "localhost", "::1"):
+            raise ValueError("The server only listens on the local host.")
+        self.address = address
+        # Schedules of codes which are not used for ttl seconds are \
+        # removed, along with their plans, keystreams and affine maps, so \
+        # the codes are not kept in memory indefinitely
+        self._schedules = _LRUCache(
+            cache_size, ttl,
+            lambda codes, schedule: _forget_schedule(schedule))
+        self._service = AsyncCipherService("thread", workers, engine=engine)
+        self._server = None
+        self._evictor = None
+        self.connections = 0
+        self.requests = 0
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        """Starts listening for clients."""
+        import asyncio
+        if isinstance(self.address, str):
+            self._server = await asyncio.start_unix_server(self._handle,
+                                                           self.address)
+            # Only the owner can send codes to the server
+            os.chmod(self.address, 0o600)
+        else:
+            self._server = await asyncio.start_server(self._handle,
+                                                      *self.address)
+        if self._schedules.ttl:
+            self._evictor = asyncio.create_task(self._evict_expired())
+
+    async def serve_forever(self):
+        """Serves clients until the task is cancelled."""
+        if self._server is None:
+            await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Stops listening, closes the pool and removes the socket file."""
+        if self._evictor is not None:
+            self._evictor.cancel()
+            self._evictor = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if isinstance(self.address, str) and \
+                    os.path.exists(self.address):
+                os.unlink(self.address)
+        await self._service.close()
+
+    def metrics(self):
+        """Returns the connection, request and cache counts."""
+        return dict(self._service.metrics(), connections=self.connections,
+                    server_requests=self.requests,
+                    schedules=len(self._schedules))
+
+    async def _evict_expired(self):
+        import asyncio
+        # Expired schedules are removed even when no requests arrive
+        while True:
+            await asyncio.sleep(min(self._schedules.ttl, 60))
+            self._schedules.evict()
+
+    async def _get_schedule(self, codes):
+        import asyncio
+        codes = tuple(check_codes(codes))
+        schedule = self._schedules.get(codes)
+        if schedule is None:
+            loop = asyncio.get_running_loop()
+            schedule = await loop.run_in_executor(None, KeySchedule, codes)
+            self._schedules.put(codes, schedule)
+        return schedule
+
+    async def _respond(self, request):
+        import asyncio
+        op = request.get("op")
+        if op == "ping":
+            return "pong"
+        if op == "metrics":
+            return self.metrics()
+        if op not in ("encrypt", "decrypt"):
+            raise ValueError(f"Unknown operation {op!r}.")
+        if op == "decrypt":
+            # Malformed ciphertexts are refused before any key schedule \
+            # is derived
+            texts = request["texts"] if "texts" in request \
+                else [request["text"]]
+            for number, (error, offset) in enumerate(
+                    validate_ciphertexts(texts), 1):
+                if error:
+                    raise ValueError(f"Ciphertext {number} is invalid: "
+                                     f"{error} error at offset {offset}.")
+        schedule = await self._get_schedule(request["codes"])
+        function = self._service.encrypt if op == "encrypt" \
+            else self._service.decrypt
+        if "texts" in request:
+            return await asyncio.gather(*[function(schedule, text)
+                                          for text in request["texts"]])
+        return await function(schedule, request["text"])
+
+    async def _handle(self, reader, writer):
+        import asyncio
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(4)
+                    request = json.loads(await reader.readexactly(
+                        _unpack_length(header)))
+                except asyncio.IncompleteReadError:
+                    break
+                self.requests += 1
+                try:
+                    response = {"ok": True,
+                                "result": await self._respond(request)}
+                except Exception as error:
+                    response = {"ok": False,
+                                "error": str(error) or type(error).__name__}
+                writer.write(_pack_message(response))
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            # The connection is dropped when the framing is broken
+            pass
+        finally:
+            writer.close()
+
+
+def serve(address, workers=None, cache_size=128, ttl=600, engine="plan"):
+    """Runs a CipherServer at the address until interrupted."""
+    import asyncio
+    server = CipherServer(address, workers, cache_size, ttl, engine)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+class CipherClient:
+    """A blocking client of CipherServer."""
+
+    def __init__(self, address, timeout=None):
+        if isinstance(address, str):
+            self._socket = socket.socket(socket.AF_UNIX)
+            self._socket.settimeout(timeout)
+            self._socket.connect(address)
+        else:
+            self._socket = socket.create_connection(address, timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes the connection."""
+        self._socket.close()
+
+    def ping(self):
+        """Checks that the server is answering."""
+        return self._request({"op": "ping"}) == "pong"
+
+    def metrics(self):
+        """Returns the metrics of the server."""
+        return self._request({"op": "metrics"})
+
+    def encrypt(self, codes, plaintext):
+        """Encrypts the plaintext on the server."""
+        return self._request({"op": "encrypt", "codes": self._codes(codes),
+                              "text": plaintext})
+
+    def decrypt(self, codes, ciphertext):
+        """Decrypts the ciphertext on the server."""
+        return self._request({"op": "decrypt", "codes": self._codes(codes),
+                              "text": ciphertext})
+
+    def encrypt_many(self, codes, plaintexts):
+        """Encrypts many plaintexts in one request."""
+        return self._request({"op": "encrypt", "codes": self._codes(codes),
+                              "texts": list(plaintexts)})
+
+    def decrypt_many(self, codes, ciphertexts):
+        """Decrypts many ciphertexts in one request."""
+        return self._request({"op": "decrypt", "codes": self._codes(codes),
+                              "texts": list(ciphertexts)})
+
+    @staticmethod
+    def _codes(codes):
+        return list(codes.codes if isinstance(codes, KeySchedule) else codes)
+
+    def _receive(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("The server closed the connection.")
+            data += chunk
+        return bytes(data)
+
+    def _request(self, request):
+        self._socket.sendall(_pack_message(request))
+        response = json.loads(self._receive(_unpack_length(
+            self._receive(4))))
+        if not response["ok"]:
+            raise ValueError(response["error"])
+        return response["result"]
+
+
+# Streams are split into frames which are encrypted independently.  Each \
+# frame is written as a header line with the number of plaintext \
+# characters and ciphertext characters, followed by the ciphertext line.
+def encrypt_stream(codes, reader, writer, chunk_size=10000, engine="plan",
+                   rng=None):
+    """
+    Reads plaintext from the reader and writes encrypted frames of up to
+    chunk_size characters to the writer as each frame is completed.
+    Returns the number of frames written.
+    """
+    if chunk_size < 10 or chunk_size % 10 != 0:
+        raise ValueError("The chunk size must be a multiple of 10.")
+    schedule = get_key_schedule(codes)
+    frames = 0
+    buffer = ""
+    while True:
+        data = reader.read(chunk_size)
+        # Only complete frames need no random characters, so the frames \
+        # are cut after the invalid characters have been removed
+        buffer += _substitute(data.upper())
+        while len(buffer) >= chunk_size or (not data and buffer):
+            frame, buffer = buffer[:chunk_size], buffer[chunk_size:]
+            ciphertext = schedule.encrypt(frame, engine, rng)
+            writer.write(f"{len(frame)} {len(ciphertext)}\n{ciphertext}\n")
+            frames += 1
+        if not data:
+            return frames
+
+
+def decrypt_stream(codes, reader, writer, engine="plan"):
+    """
+    Reads the frames written by encrypt_stream from the reader and writes
+    the plaintext of each frame to the writer.  Returns the number of
+    frames read.
+    """
+    schedule = get_key_schedule(codes)
+    frames = 0
+    while True:
+        header = reader.readline()
+        if not header:
+            return frames
+        try:
+            plain_len, cipher_len = [int(n) for n in header.split()]
+        except ValueError:
+            raise ValueError(f"Invalid frame header in frame {frames + 1}.") \
+                from None
+        ciphertext = reader.read(cipher_len)
+        if len(ciphertext) != cipher_len or reader.read(1) != "\n":
+            raise ValueError(f"Frame {frames + 1} is incomplete.")
+        # The random characters added to the last frame are removed
+        writer.write(schedule.decrypt(ciphertext, engine)[:plain_len])
+        frames += 1
+
+
+def _ciphertext_length(length):
+    """
+    Returns the length of the ciphertext of a plaintext with the given
+    number of characters after _substitute.
+    """
+    # _add_random pads to a multiple of 10, _add_two_random adds 2 for \
+    # every 10, each symbol becomes two letters and _adds_spaces adds one \
+    # space after every 5 letters
+    letters = -(-length // 10) * 12 * 2
+    return letters + letters // 5
+
+
+def _records(buffer):
+    """
+    Yields each line of the buffer as a memoryview, without the line
+    ending, so that the records are not copied.
+    """
+    view = memoryview(buffer)
+    start = 0
+    while start < len(view):
+        end = buffer.find(b"\n", start)
+        if end < 0:
+            end = len(view)
+        record = view[start:end]
+        if record[-1:] == b"\r":
+            record = record[:-1]
+        yield record
+        start = end + 1
+
+
+def _file_numbers(record):
+    """Returns the reference numbers of the substituted plaintext record."""
+    numbers = _FILE_ENCODE[np.frombuffer(record, dtype=np.uint8)]
+    return numbers[numbers != _INVALID]
+
+
+def _file_letters(record):
+    """Returns the code letter numbers of the ciphertext record."""
+    data = np.frombuffer(record, dtype=np.uint8)
+    # Characters which _substitute removes, such as spaces, are ignored
+    letters = _FILE_LETTER_ENCODE[data[_FILE_REFERENCE[data] != _INVALID]]
+    if (letters == _INVALID).any():
+        raise ValueError("Invalid character used.")
+    return letters
+
+
+def _write_rows(output, starts, rows, spaces=False):
+    """
+    Writes the byte rows into the output array at the starting offsets,
+    each followed by a new line and, for ciphertexts, with a space after
+    every 5 letters.
+    """
+    width = rows.shape[1]
+    columns = np.arange(width)
+    if spaces:
+        columns += columns // 5
+        output[starts[:, None] + np.arange(5, width + width // 5, 6)] = \
+            ord(" ")
+        width += width // 5
+    output[starts[:, None] + columns] = rows
+    output[starts + width] = ord("\n")
+
+
+def _map_files(input_path, output_path, size_of):
+    """
+    Maps the input file and an output file of the size given by size_of
+    for each record.  Returns the input buffer, the output map and the
+    output array, or empty buffers for an empty input.
+    """
+    with open(input_path, "rb") as file:
+        if os.fstat(file.fileno()).st_size:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buffer = b""
+    total = 0
+    for number, record in enumerate(_records(buffer), 1):
+        try:
+            total += size_of(record) + 1
+        except ValueError as error:
+            raise ValueError(f"Record {number}: {error}") from None
+    with open(output_path, "w+b") as file:
+        file.truncate(total)
+        if not total:
+            return buffer, None, np.empty(0, dtype=np.uint8)
+        output = mmap.mmap(file.fileno(), total, access=mmap.ACCESS_WRITE)
+    return buffer, output, np.frombuffer(output, dtype=np.uint8)
+
+
+def _process_file(input_path, output_path, size_of, convert, process,
+                  batch_size):
+    """
+    Runs the conversion and processing of the records in batches, writing
+    each result at its offset in the preallocated output file.
+    """
+    if batch_size < 1:
+        raise ValueError("The batch size must be at least 1.")
+    buffer, output_map, output = _map_files(input_path, output_path,
+                                            size_of)
+    records = _records(buffer)
+    offset = 0
+    count = 0
+    try:
+        while True:
+            batch = [convert(record)
+                     for record in islice(records, batch_size)]
+            if not batch:
+                break
+            groups = {}
+            for message in batch:
+                # Empty records are written as empty lines
+                if not len(message):
+                    output[offset] = ord("\n")
+                    offset += 1
+                    continue
+                groups.setdefault(len(message), []).append(
+                    (offset, message))
+                offset += size_of(message, converted=True) + 1
+            for length, rows in groups.items():
+                starts = np.array([start for start, _ in rows])
+                process(output, starts, np.stack([row for _, row in rows]))
+            count += len(batch)
+        if output_map is not None:
+            output_map.flush()
+    finally:
+        # The views of the maps are released before the maps are closed
+        records.close()
+        del output
+        if output_map is not None:
+            output_map.close()
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
+    return count
+
+
+def encrypt_file(codes, input_path, output_path, engine="plan",
+                 batch_size=1024, rng=None):
+    """
+    Encrypts each line of the input file into the same line of the output
+    file and returns the number of lines.  The input is memory mapped and
+    the output file is sized before it is written, so only one batch of
+    lines is held in memory.  Non-ASCII characters are removed and empty
+    lines are left empty.
+    """
+    schedule = get_key_schedule(codes)
+    encrypt_numbers = _get_number_engine(engine)[0]
+
+    def size_of(record, converted=False):
+        if converted:
+            return _ciphertext_length(len(record))
+        if not len(record):
+            return 0
+        length = int(np.count_nonzero(_FILE_ENCODE[
+            np.frombuffer(record, dtype=np.uint8)] != _INVALID))
+        if not length:
+            raise ValueError("The message has no characters to encrypt.")
+        return _ciphertext_length(length)
+
+    def convert(record):
+        if not len(record):
+            return np.empty(0, dtype=int)
+        numbers = _file_numbers(record)
+        # The random letters are added in the order of the lines
+        padding = _add_random("^" * (len(numbers) % 10), rng)
+        padding = _text_to_numbers(padding[len(numbers) % 10:])
+        return np.concatenate([numbers, padding]).astype(int)
+
+    def process(output, starts, numbers):
+        letters = encrypt_numbers(schedule, numbers)
+        _write_rows(output, starts, _FILE_LETTER_DECODE[letters], True)
+
+    return _process_file(input_path, output_path, size_of, convert, process,
+                         batch_size)
+
+
+def decrypt_file(codes, input_path, output_path, engine="plan",
+                 batch_size=1024):
+    """
+    Decrypts each line of the input file into the same line of the output
+    file and returns the number of lines, in the same way as encrypt_file.
+    """
+    schedule = get_key_schedule(codes)
+    decrypt_numbers = _get_number_engine(engine)[1]
+
+    def size_of(record, converted=False):
+        if converted:
+            return len(record) * 10 // 24
+        if not len(record):
+            return 0
+        letters = _file_letters(record)
+        if not len(letters) or len(letters) % 24 != 0:
+            raise ValueError("The encrypted message should be a multiple "
+                             "of 24 letters.")
+        return len(letters) * 10 // 24
+
+    def process(output, starts, letters):
+        numbers = decrypt_numbers(schedule, letters.astype(int))
+        _write_rows(output, starts, _FILE_DECODE[numbers])
+
+    return _process_file(input_path, output_path, size_of, _file_letters,
+                         process, batch_size)
+
+
+def _encrypt_schedule(schedule, plaintext, rng=None):
+    """Encrypts the given plaintext with the given key schedule."""
     # Initialises codes
-    code1, code2, code3 = codes
-    code_reference, code_order5, code_order6, code_order24, \
-    code_a, code_b, code_order5_inv, code_order6_inv, code_order24_inv, \
-    extra_cycle = _rearrangement(code1, code2, code3)
-    # The cycle number is varailbe with a numer between 12 and 60
-    # The cycle number is variable so that thelst last code reference used \
-    # in the cipher is not known
-    cycle = 12 + extra_cycle
+    code_reference = schedule.code_reference
+    code_order5 = schedule.code_order5
+    code_order6 = schedule.code_order6
+    code_order24 = schedule.code_order24
+    code_a = schedule.code_a
+    code_b = schedule.code_b
+    cycle = schedule.cycle
+    profiler = _active_profiler()
+    if profiler:
+        profiler.start()
 
     # Converts to uppercase, substitutes spaces and removes invalid characters
     ciphertext = plaintext.upper()
@@ -760,148 +3257,483 @@ def encrypt(codes, plaintext):
 
     # Adds a space character and then random characters as needed until
     # there is a multiple of 10 characters
-    ciphertext = _add_random(ciphertext)
+    ciphertext = _add_random(ciphertext, rng)
+    if profiler:
+        profiler.lap("input", ciphertext)
 
     for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
         # A. Performs a Vigenere / Bellaso cipher
         ciphertext = _vigenere(ciphertext, code_reference, i, cycle)
+        if profiler:
+            profiler.lap("A", ciphertext)
 
         # B. Rearranges a group of letters
         ciphertext = _rearrange(ciphertext, code_order5, i, cycle)
+        if profiler:
+            profiler.lap("B", ciphertext)
 
         # C. Groups odd and even letters
         ciphertext = _odds_evens(ciphertext, code_a, i)
+        if profiler:
+            profiler.lap("C", ciphertext)
 
         # D. Adds adjacent letters
         ciphertext = _chain_addition(ciphertext, code_b, code_a, i)
+        if profiler:
+            profiler.lap("D", ciphertext)
 
         # E. Reversal of word
         ciphertext = _reversal(ciphertext)
+        if profiler:
+            profiler.lap("E", ciphertext)
 
         # F. Rearranges sections
         ciphertext = _group_rearrange(ciphertext, code_order5, i)
+        if profiler:
+            profiler.lap("F", ciphertext)
+            profiler.end_cycle("phase one")
 
     # G. Adds 2 random characters for every 10 charactrs in the message
     ciphertext = _add_two_random(ciphertext)
+    if profiler:
+        profiler.lap("G", ciphertext)
 
     # H. Converts message into the 2D AMNVWXZ array letters
     ciphertext = _2D_array(ciphertext)
+    if profiler:
+        profiler.lap("H", ciphertext)
 
     for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
 
         # I. Transposition with rearrangement of columns
         ciphertext = _transposition(ciphertext, code_order6, i, cycle)
+        if profiler:
+            profiler.lap("I", ciphertext)
 
         # J. Reversal of word
         ciphertext = _reversal(ciphertext)
+        if profiler:
+            profiler.lap("J", ciphertext)
 
         # K. Peferms a Hill function
         ciphertext = _hill_function(ciphertext)
+        if profiler:
+            profiler.lap("K", ciphertext)
 
         # L. Rearranges a group of letters
         ciphertext = _rearrange(ciphertext, code_order6, i, cycle)
+        if profiler:
+            profiler.lap("L", ciphertext)
 
         # M. Rearranges sections
         ciphertext = _group_rearrange(ciphertext, code_order24, i)
+        if profiler:
+            profiler.lap("M", ciphertext)
 
         # N. Adds adjacent letters
         ciphertext = _chain_addition(ciphertext, code_a, code_b, i, True)
+        if profiler:
+            profiler.lap("N", ciphertext)
 
         # O. Groups odd and even letters
         ciphertext = _odds_evens(ciphertext, code_a, i)
+        if profiler:
+            profiler.lap("O", ciphertext)
 
         # P. Rearranges a group of letters
         ciphertext = _rearrange(ciphertext, code_order24, i, cycle)
+        if profiler:
+            profiler.lap("P", ciphertext)
 
         # Q. Rearranges sections
         ciphertext = _group_rearrange(ciphertext, code_order6, i)
+        if profiler:
+            profiler.lap("Q", ciphertext)
 
         # R. Performs a Vigenere / Bellaso cipher
         ciphertext = _bellaso(ciphertext, code_reference, i, cycle)
+        if profiler:
+            profiler.lap("R", ciphertext)
+            profiler.end_cycle("phase two")
 
     # S. Adds one space for every five characters
     ciphertext = _adds_spaces(ciphertext)
+    if profiler:
+        profiler.lap("S", ciphertext)
 
     return ciphertext
 
 
-def decrypt(codes, ciphertext):
-    """Decrypts the given ciphertext with the given codes."""
+def _decrypt_schedule(schedule, ciphertext):
+    """Decrypts the given ciphertext with the given key schedule."""
     # Initialises codes
-    code1, code2, code3 = codes
-    code_reference, code_order5, code_order6, code_order24, \
-    code_a, code_b, code_order5_inv, code_order6_inv, code_order24_inv, \
-    extra_cycle = _rearrangement(code1, code2, code3)
-    cycle = 12 + extra_cycle
+    code_reference = schedule.code_reference
+    code_order6 = schedule.code_order6
+    code_a = schedule.code_a
+    code_b = schedule.code_b
+    code_order5_inv = schedule.code_order5_inv
+    code_order6_inv = schedule.code_order6_inv
+    code_order24_inv = schedule.code_order24_inv
+    cycle = schedule.cycle
+    profiler = _active_profiler()
+    if profiler:
+        profiler.start()
 
     # S. Removes spaces from encypted message
     ciphertext = _substitute(ciphertext, spaces=False)
+    _check_letter_count(len(ciphertext))
+    if profiler:
+        profiler.lap("S", ciphertext)
 
     for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
 
         # R. Performs a Vigenere / Bellaso cipher
         ciphertext = _bellaso(ciphertext, code_reference, i, cycle, True)
+        if profiler:
+            profiler.lap("R", ciphertext)
 
         # Q. Rearranges sections
         ciphertext = _group_back(ciphertext, code_order6_inv, i, cycle)
+        if profiler:
+            profiler.lap("Q", ciphertext)
 
         # P. Rearranges a group of letters
         ciphertext = _rearrange(ciphertext, code_order24_inv, i, cycle, True)
+        if profiler:
+            profiler.lap("P", ciphertext)
 
         # O. Groups back odd and even letters
         ciphertext = _back_odd_evens(ciphertext, code_a, i, cycle)
+        if profiler:
+            profiler.lap("O", ciphertext)
 
         # N. Subtracts adjacent letters
         ciphertext = _chain_sub(ciphertext, code_a, code_b, i, cycle, True)
+        if profiler:
+            profiler.lap("N", ciphertext)
 
         # M. Rearranges a group of letters
         ciphertext = _group_back(ciphertext, code_order24_inv, i, cycle)
+        if profiler:
+            profiler.lap("M", ciphertext)
 
         # L. Rearranges a group of letters
         ciphertext = _rearrange(ciphertext, code_order6_inv, i, cycle, True)
+        if profiler:
+            profiler.lap("L", ciphertext)
 
         # K. Performs an inverse Hill function
         ciphertext = _hill_function(ciphertext, True)
+        if profiler:
+            profiler.lap("K", ciphertext)
 
         # J. Reversal of word
         ciphertext = _reversal(ciphertext)
+        if profiler:
+            profiler.lap("J", ciphertext)
 
         # I. Transposition with rearrangement of columns
         ciphertext = _back_transposition(ciphertext, code_order6, i, cycle)
+        if profiler:
+            profiler.lap("I", ciphertext)
+            profiler.end_cycle("phase two")
 
     # H. Returns message from 2D array AMNVWXZ letters
     ciphertext = _retrun_from_array(ciphertext)
+    if profiler:
+        profiler.lap("H", ciphertext)
 
     # G. Removes added random letters
     ciphertext = _remove_two_random(ciphertext)
+    if profiler:
+        profiler.lap("G", ciphertext)
 
     for i in range(cycle):
+        if profiler:
+            profiler.start_cycle()
 
         # F. Rearranges a group of letters
         ciphertext = _group_back(ciphertext, code_order5_inv, i, cycle)
+        if profiler:
+            profiler.lap("F", ciphertext)
 
         # E. Reversal of word
         ciphertext = _reversal(ciphertext)
+        if profiler:
+            profiler.lap("E", ciphertext)
 
         # D. Subtracts adjacent letters
         ciphertext = _chain_sub(ciphertext, code_b, code_a, i, cycle)
+        if profiler:
+            profiler.lap("D", ciphertext)
 
         # C. Groups back odd and even letters
         ciphertext = _back_odd_evens(ciphertext, code_a, i, cycle)
+        if profiler:
+            profiler.lap("C", ciphertext)
 
         # B. Rearranges a group of letters
         ciphertext = _rearrange(ciphertext, code_order5_inv, i, cycle, True)
+        if profiler:
+            profiler.lap("B", ciphertext)
 
         # A. Performs a Vigenere / Bellaso cipher
         ciphertext = _vigenere(ciphertext, code_reference, i, cycle, True)
+        if profiler:
+            profiler.lap("A", ciphertext)
+            profiler.end_cycle("phase one")
 
     # Converts space character for a space again
     ciphertext = _reinstate_space(ciphertext)
+    if profiler:
+        profiler.lap("output", ciphertext)
     plaintext = ciphertext
 
     return plaintext
 
 
+# The reference engine runs every stage on strings, the array engine \
+# converts the message to numbers once and runs every stage on arrays, \
+# the plan engine also gathers each run of permutations in one step, \
+# the affine engine also runs phase one of short messages as one product \
+# and the scratch engine runs the plan stages in preallocated buffers
+ENGINES = {
+    "reference": (_encrypt_schedule, _decrypt_schedule),
+    "array": (_encrypt_array, _decrypt_array),
+    "plan": (_encrypt_plan, _decrypt_plan),
+    "affine": (_encrypt_affine, _decrypt_affine),
+    "scratch": (_encrypt_scratch, _decrypt_scratch),
+}
+# The array functions of the engines which can process 2D batches
+NUMBER_ENGINES = {
+    "array": (_encrypt_numbers, _decrypt_numbers),
+    "plan": (_encrypt_plan_numbers, _decrypt_plan_numbers),
+    "affine": (_encrypt_affine_numbers, _decrypt_affine_numbers),
+    "scratch": (_encrypt_scratch_numbers, _decrypt_scratch_numbers),
+}
+
+
+def _check_plaintext(plaintext):
+    """
+    Checks a plaintext has no ? and has characters to encrypt.  Unlike
+    setplaintext there is no limit on the length.
+    """
+    if "?" in plaintext:
+        raise ValueError("'?' cannot be used.")
+    if not _substitute(plaintext.upper()):
+        raise ValueError("The message has no characters to encrypt.")
+    return plaintext
+
+
+def _check_ciphertext(ciphertext):
+    """Checks a ciphertext with validdate_message."""
+    if not ciphertext or not validdate_message(ciphertext):
+        raise ValueError("Invalid encrypted message.")
+    return ciphertext
+
+
+def _bulk_records(reader, check):
+    """
+    Yields the checked lines of the reader without the line endings.
+    Blank lines are yielded as empty strings without being checked.
+    """
+    for number, line in enumerate(reader, 1):
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            yield ""
+            continue
+        try:
+            yield check(line)
+        except ValueError as error:
+            raise ValueError(f"Line {number}: {error}") from None
+
+
+def _write_results(records, run, writer):
+    """
+    Writes one line for each record, the result of run for the records
+    which are not empty and a blank line for the empty records.  run is
+    given an iterator of the records which are not empty and must yield
+    their results in order.
+    """
+    blanks = deque()
+
+    def texts():
+        for record in records:
+            blanks.append(not record)
+            if record:
+                yield record
+
+    for result in run(texts()):
+        # The record of each result has been read, so its flag comes \
+        # after the flags of the blank records before it
+        while blanks.popleft():
+            writer.write("\n")
+        writer.write(result + "\n")
+    for _ in blanks:
+        writer.write("\n")
+
+
+def _run_bulk(args, codes, reader, writer):
+    """Encrypts or decrypts one message per line of the reader."""
+    encrypting = args.command == "encrypt"
+    records = _bulk_records(reader, _check_plaintext if encrypting
+                            else _check_ciphertext)
+    if args.jobs > 1:
+        with ParallelCipher(codes, args.jobs, args.batch_size,
+                            args.engine) as pool:
+            _write_results(records, pool.imap_encrypt if encrypting
+                           else pool.imap_decrypt, writer)
+        return
+    schedule = get_key_schedule(codes)
+    process = schedule.encrypt_many if encrypting else schedule.decrypt_many
+
+    def run(texts):
+        # The lines are read one batch at a time so large files are not \
+        # held in memory
+        while True:
+            batch = list(islice(texts, args.batch_size))
+            if not batch:
+                return
+            yield from process(batch, args.engine, args.batch_size)
+
+    _write_results(records, run, writer)
+
+
+def _run_command(args, codes, reader, writer):
+    """Runs the encrypt or decrypt command on the opened files."""
+    if args.bulk:
+        _run_bulk(args, codes, reader, writer)
+    elif args.stream and args.command == "encrypt":
+        encrypt_stream(codes, reader, writer, args.chunk_size, args.engine)
+    elif args.stream:
+        decrypt_stream(codes, reader, writer, args.engine)
+    elif args.command == "encrypt":
+        plaintext = _check_plaintext(reader.read().rstrip("\r\n"))
+        writer.write(encrypt(codes, plaintext, args.engine) + "\n")
+    else:
+        ciphertext = _check_ciphertext(reader.read().strip())
+        writer.write(decrypt(codes, ciphertext, args.engine) + "\n")
+
+
+def _parse_args(argv):
+    """Parses the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Encrypts and decrypts messages with the substitution "
+                    "- permutation cipher.  Run without arguments for the "
+                    "interactive menu.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ["encrypt", "decrypt"]:
+        sub = commands.add_parser(command, help=f"{command} messages")
+        codes = sub.add_mutually_exclusive_group(required=True)
+        codes.add_argument("--codes-file",
+                           help="file with the three pass codes, one per "
+                                "line")
+        codes.add_argument("--codes", nargs=3, metavar="CODE",
+                           help="the three pass codes")
+        codes.add_argument("--schedule-file",
+                           help="key schedule saved by the schedule command")
+        sub.add_argument("-i", "--input", default="-",
+                         help="input file (default: stdin)")
+        sub.add_argument("-o", "--output", default="-",
+                         help="output file (default: stdout)")
+        mode = sub.add_mutually_exclusive_group()
+        mode.add_argument("--bulk", action="store_true",
+                          help="one message per line, processed in batches")
+        mode.add_argument("--stream", action="store_true",
+                          help="read and write frames of encrypt_stream, "
+                               "for inputs of any size")
+        sub.add_argument("--jobs", type=int, default=1,
+                         help="worker processes for --bulk (default: 1)")
+        sub.add_argument("--engine", choices=sorted(ENGINES), default="plan",
+                         help="cipher engine (default: plan)")
+        sub.add_argument("--batch-size", type=int, default=1024,
+                         help="messages per batch for --bulk "
+                              "(default: 1024)")
+        if command == "encrypt":
+            sub.add_argument("--chunk-size", type=int, default=10000,
+                             help="characters per frame for --stream "
+                                  "(default: 10000)")
+    schedule_parser = commands.add_parser(
+        "schedule", help="save the key schedule of the pass codes, which "
+                         "is quicker to load than deriving it")
+    codes = schedule_parser.add_mutually_exclusive_group(required=True)
+    codes.add_argument("--codes-file",
+                       help="file with the three pass codes, one per line")
+    codes.add_argument("--codes", nargs=3, metavar="CODE",
+                       help="the three pass codes")
+    schedule_parser.add_argument("-o", "--output", required=True,
+                                 help="file to save the key schedule to")
+    serve_parser = commands.add_parser(
+        "serve", help="run a local server which keeps key schedules")
+    address = serve_parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--socket", help="path of the Unix socket")
+    address.add_argument("--port", type=int,
+                         help="TCP port on the local host")
+    serve_parser.add_argument("--workers", type=int, default=None,
+                              help="worker threads (default: CPU count)")
+    serve_parser.add_argument("--cache-size", type=int, default=128,
+                              help="key schedules kept (default: 128)")
+    serve_parser.add_argument("--ttl", type=float, default=600,
+                              help="seconds an unused key schedule is "
+                                   "kept (default: 600)")
+    serve_parser.add_argument("--engine", choices=sorted(NUMBER_ENGINES),
+                              default="plan",
+                              help="cipher engine (default: plan)")
+    args = parser.parse_args(argv)
+    if args.command in ("schedule", "serve"):
+        return args
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.jobs > 1 and not args.bulk:
+        parser.error("--jobs can only be used with --bulk")
+    if args.bulk and args.engine not in NUMBER_ENGINES:
+        parser.error(f"--bulk needs an engine which can process batches: "
+                     f"{', '.join(sorted(NUMBER_ENGINES))}")
+    return args
+
+
+def cli(argv=None):
+    """
+    Runs the command line interface, for example
+    `python SP_network_cipher.py encrypt --codes-file codes.txt -i in.txt`.
+    """
+    args = _parse_args(argv)
+    if args.command == "serve":
+        serve(args.socket or ("127.0.0.1", args.port), args.workers,
+              args.cache_size, args.ttl, args.engine)
+        return
+    try:
+        if getattr(args, "schedule_file", None):
+            codes = load_key_schedule(args.schedule_file)
+        elif args.codes_file:
+            codes = read_codes(args.codes_file)
+        else:
+            codes = check_codes(args.codes)
+        if args.command == "schedule":
+            save_key_schedule(codes, args.output)
+            return
+        reader = sys.stdin if args.input == "-" else open(args.input)
+        try:
+            writer = sys.stdout if args.output == "-" \
+                else open(args.output, "w")
+            try:
+                _run_command(args, codes, reader, writer)
+            finally:
+                if writer is not sys.stdout:
+                    writer.close()
+        finally:
+            if reader is not sys.stdin:
+                reader.close()
+    except (OSError, ValueError) as error:
+        raise SystemExit(f"Error: {error}")
+
+
 def test():
     """Automatically checks whether the program is working correctly"""
     # Use autocode or input your own code
@@ -919,8 +3751,14 @@ def test():
         print("Wrong encryption")
 
 
-def main():
+def main(argv=None):
     """The starting point of the program."""
+    # Runs the command line interface when arguments are given
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv:
+        return cli(argv)
+
     # Unblock the test() function, to quickly check the program
     #test()
     #return
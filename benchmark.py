@@ -0,0 +1,357 @@
+# Benchmarks for the substitution - permutation cipher.
+# Run `python benchmark.py chain` to see how the chain addition and
+# chain subtraction stages scale with the message length.
+# Run `python benchmark.py import` to check the start up cost.
+# Run `python benchmark.py suite --save results.json` to time the key
+# schedule, both phases, encrypt and decrypt, and later
+# `python benchmark.py suite --compare results.json` to find regressions.
+# Run `python benchmark.py server` to load test the local cipher server.
+# Run `python benchmark.py memory` to trace the bytes each engine allocates.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, sleep
+from timeit import repeat
+
+import SP_network_cipher as cipher
+
+# Fixed pass codes so that the timings can be compared between runs
+CODES = ["QWERTYUIOP12", "ZXCVBNM@#$%^", "ASDFGHJKL()*"]
+LENGTHS = [10, 100, 1000, 10000]
+# The most time the import may add on top of importing NumPy
+IMPORT_BUDGET = 0.15
+# Fixed pass codes giving the fewest (12) and the most (60) cycles
+SUITE_CODES = {
+    12: ["#O??$KV8W6M@", "A%F8VN!S1R8_", "IZ5ZUC))7UWK"],
+    60: ["D2*JT98-_#)J", "RYN#QE(4(6E&", "F$AEV^K0SMJR"],
+}
+SUITE_ENGINES = ["array", "plan", "affine", "scratch"]
+# Timings this much slower than the saved timings are marked
+REGRESSION_RATIO = 1.2
+# Clients and requests per client of the server load test
+SERVER_CLIENTS = 8
+SERVER_REQUESTS = 200
+
+
+def _best_time(function, repeats=5):
+    """Returns the best time in seconds of one call of the function."""
+    # The number of calls per repeat is scaled so each repeat is measurable
+    number = 1
+    while True:
+        elapsed = min(repeat(function, number=number, repeat=1))
+        if elapsed > 0.05 or number >= 10000:
+            break
+        number *= 10
+    return min(repeat(function, number=number, repeat=repeats)) / number
+
+
+def _message(length):
+    """Returns a fixed message of the given length."""
+    text = "THE QUICK BROWN FOX JUMPS OVER THE LAZY DOG 0123456789 "
+    return (text * (length // len(text) + 1))[:length]
+
+
+def _print_table(title, headers, rows):
+    """Prints the rows as a plain text table."""
+    print(f"\n{title}")
+    widths = [max(len(str(row[k])) for row in [headers] + rows)
+              for k in range(len(headers))]
+    for row in [headers] + rows:
+        print("  ".join(str(cell).rjust(width)
+                        for cell, width in zip(row, widths)))
+
+
+def bench_chain(lengths=LENGTHS):
+    """Times the chain addition and subtraction stages of both phases."""
+    schedule = cipher.get_key_schedule(CODES)
+    code_a, code_b, cycle = schedule.code_a, schedule.code_b, schedule.cycle
+    rows = []
+    for length in lengths:
+        # Phase one works on the padded plaintext, phase two on twice as \
+        # many AMNVWXZ letters after the two random characters are added
+        text = cipher._add_random(cipher._substitute(_message(length)))
+        letters = cipher._2D_array(cipher._add_two_random(text))
+        cases = [
+            ("D", lambda: cipher._chain_addition(text, code_b, code_a, 0)),
+            ("D inv", lambda: cipher._chain_sub(text, code_b, code_a, 0,
+                                                cycle)),
+            ("N", lambda: cipher._chain_addition(letters, code_a, code_b, 0,
+                                                 True)),
+            ("N inv", lambda: cipher._chain_sub(letters, code_a, code_b, 0,
+                                                cycle, True)),
+        ]
+        for stage, function in cases:
+            symbols = len(text) if stage.startswith("D") else len(letters) // 2
+            seconds = _best_time(function)
+            rows.append([stage, length, symbols, f"{seconds * 1e6:.1f}",
+                         f"{seconds * 1e9 / symbols:.1f}"])
+    _print_table("Chain addition / subtraction",
+                 ["stage", "length", "symbols", "us/call", "ns/symbol"], rows)
+    return rows
+
+
+def _run_python(statement, check=True):
+    """Runs the statement in a new interpreter next to the cipher module."""
+    directory = os.path.dirname(os.path.abspath(cipher.__file__))
+    return subprocess.run([sys.executable, "-c", statement], cwd=directory,
+                          check=check)
+
+
+def _import_time(statement, repeats):
+    """Returns the best time of running the statement in a new interpreter."""
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        _run_python(statement)
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def bench_import(repeats=5):
+    """Times a fresh import of the cipher and checks it is within budget."""
+    baseline = _import_time("import numpy", repeats)
+    seconds = _import_time("import SP_network_cipher", repeats)
+    rows = [["import numpy", f"{baseline * 1e3:.0f}"],
+            ["import SP_network_cipher", f"{seconds * 1e3:.0f}"],
+            ["difference", f"{(seconds - baseline) * 1e3:.0f}"]]
+    _print_table("Import time", ["statement", "ms"], rows)
+    # SymPy alone takes longer than the whole budget to import
+    result = _run_python(
+        "import sys, SP_network_cipher; sys.exit('sympy' in sys.modules)",
+        check=False)
+    if result.returncode:
+        raise SystemExit("Importing the cipher imports SymPy.")
+    if seconds - baseline > IMPORT_BUDGET:
+        raise SystemExit(f"The import takes more than {IMPORT_BUDGET * 1e3:.0f}"
+                         f" ms on top of NumPy.")
+    return rows
+
+
+def _suite_row(benchmark, engine, cycles, length, seconds):
+    """Returns one result of the suite."""
+    return {"name": f"{benchmark}/{engine}/{cycles}/{length}",
+            "benchmark": benchmark, "engine": engine, "cycles": cycles,
+            "length": length, "seconds": seconds}
+
+
+def bench_suite(lengths=LENGTHS, engines=SUITE_ENGINES, repeats=3):
+    """
+    Times the key schedule, both phases of encryption, encrypt and decrypt
+    for each engine, message length and the fewest and most cycles.
+    """
+    results = []
+    for cycles, codes in SUITE_CODES.items():
+        seconds = _best_time(lambda: cipher._rearrangement(*codes), repeats)
+        results.append(_suite_row("key schedule", "-", cycles, 0, seconds))
+        schedule = cipher.KeySchedule(codes)
+        for engine in engines:
+            for length in lengths:
+                # The lengths are multiples of 10, so no random characters \
+                # are added and the ciphertext is always the same
+                plaintext = _message(length)
+                ciphertext = schedule.encrypt(plaintext, engine)
+                # The phases are timed by the cycles of the stage profiler
+                phases = {"phase one": [], "phase two": []}
+                for _ in range(repeats):
+                    with cipher.StageProfiler() as profiler:
+                        schedule.encrypt(plaintext, engine)
+                    for phase, times in phases.items():
+                        times.append(profiler.cycles[phase][1])
+                for phase, times in phases.items():
+                    results.append(_suite_row(phase, engine, cycles, length,
+                                              min(times)))
+                seconds = _best_time(
+                    lambda: schedule.encrypt(plaintext, engine), repeats)
+                results.append(_suite_row("encrypt", engine, cycles, length,
+                                          seconds))
+                seconds = _best_time(
+                    lambda: schedule.decrypt(ciphertext, engine), repeats)
+                results.append(_suite_row("decrypt", engine, cycles, length,
+                                          seconds))
+    return results
+
+
+def _revision():
+    """Returns the git revision of the cipher, if known."""
+    directory = os.path.dirname(os.path.abspath(cipher.__file__))
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                cwd=directory, capture_output=True,
+                                text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return result.stdout.strip()
+
+
+def save_results(results, path):
+    """Saves the suite results with the revision they were measured on."""
+    with open(path, "w") as file:
+        json.dump({"revision": _revision(),
+                   "python": sys.version.split()[0],
+                   "numpy": cipher.np.__version__,
+                   "results": results}, file, indent=2)
+
+
+def compare_results(results, path):
+    """Prints the suite results against the results saved in the file."""
+    with open(path) as file:
+        saved = json.load(file)
+    old = {row["name"]: row["seconds"] for row in saved["results"]}
+    rows = []
+    for row in results:
+        if row["name"] not in old:
+            continue
+        ratio = row["seconds"] / old[row["name"]]
+        rows.append([row["name"], f"{old[row['name']] * 1e3:.3f}",
+                     f"{row['seconds'] * 1e3:.3f}", f"{ratio:.2f}",
+                     "slower" if ratio > REGRESSION_RATIO else ""])
+    _print_table(f"Compared with revision {saved['revision']}",
+                 ["benchmark", "old ms", "new ms", "ratio", ""], rows)
+    return rows
+
+
+def _start_server(path):
+    """Starts the cipher server in a new interpreter and waits for it."""
+    process = subprocess.Popen([sys.executable, cipher.__file__, "serve",
+                                "--socket", path])
+    deadline = perf_counter() + 10
+    while True:
+        try:
+            with cipher.CipherClient(path) as client:
+                client.ping()
+            return process
+        except OSError:
+            if perf_counter() > deadline or process.poll() is not None:
+                process.kill()
+                raise SystemExit("The server did not start.")
+            sleep(0.05)
+
+
+def bench_server(clients=SERVER_CLIENTS, requests=SERVER_REQUESTS,
+                 length=100):
+    """
+    Measures the requests per second of the local server with many
+    clients, against one command line call per message.
+    """
+    plaintext = _message(length)
+
+    def run_client(path):
+        with cipher.CipherClient(path) as client:
+            for _ in range(requests):
+                client.encrypt(CODES, plaintext)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "cipher.sock")
+        process = _start_server(path)
+        try:
+            start = perf_counter()
+            with ThreadPoolExecutor(clients) as pool:
+                list(pool.map(run_client, [path] * clients))
+            seconds = perf_counter() - start
+        finally:
+            process.terminate()
+            process.wait()
+    total = clients * requests
+    # Each command line call pays the start up and the key schedule
+    start = perf_counter()
+    subprocess.run([sys.executable, cipher.__file__, "encrypt", "--codes",
+                    *CODES], input=plaintext, capture_output=True,
+                   text=True, check=True)
+    cli_seconds = perf_counter() - start
+    rows = [["server", clients, total, f"{total / seconds:.0f}",
+             f"{seconds * 1e3 / total:.2f}"],
+            ["command line", 1, 1, f"{1 / cli_seconds:.1f}",
+             f"{cli_seconds * 1e3:.2f}"]]
+    _print_table(f"Server load test, {length} character messages",
+                 ["mode", "clients", "requests", "requests/s", "ms/request"],
+                 rows)
+    return rows
+
+
+def bench_memory(lengths=LENGTHS, engines=SUITE_ENGINES):
+    """
+    Traces the peak and total bytes allocated by one encrypt and one
+    decrypt of each engine and message length.
+    """
+    schedule = cipher.get_key_schedule(CODES)
+    rows = []
+    for engine in engines:
+        for length in lengths:
+            plaintext = _message(length)
+            # The first calls build the cached plans, which are not counted
+            ciphertext = schedule.encrypt(plaintext, engine)
+            schedule.decrypt(ciphertext, engine)
+            with cipher.MemoryProfiler() as profiler:
+                schedule.encrypt(plaintext, engine)
+                schedule.decrypt(ciphertext, engine)
+            for name in ("encrypt", "decrypt"):
+                _, allocated, peak = profiler.calls[name]
+                rows.append([name, engine, length, peak, allocated])
+    _print_table("Memory", ["call", "engine", "length", "peak bytes",
+                            "allocated bytes"], rows)
+    return rows
+
+
+BENCHMARKS = {
+    "chain": bench_chain,
+    "import": bench_import,
+    "memory": bench_memory,
+    "server": bench_server,
+    "suite": bench_suite,
+}
+
+
+def main():
+    """Runs the requested benchmarks."""
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the substitution - permutation cipher.")
+    parser.add_argument("benchmarks", nargs="*", choices=sorted(BENCHMARKS),
+                        help="benchmarks to run, all of them by default")
+    parser.add_argument("--engine", action="append", dest="engines",
+                        choices=sorted(cipher.ENGINES),
+                        help="engine for the suite and the memory "
+                             "benchmark, may be repeated "
+                             f"(default: {' '.join(SUITE_ENGINES)})")
+    parser.add_argument("--lengths", nargs="+", type=int, default=LENGTHS,
+                        help="message lengths for the suite and the "
+                             "memory benchmark")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="timing repeats for the suite")
+    parser.add_argument("--save", help="file to save the suite results to")
+    parser.add_argument("--compare",
+                        help="file of saved suite results to compare with")
+    parser.add_argument("--clients", type=int, default=SERVER_CLIENTS,
+                        help="clients of the server load test")
+    parser.add_argument("--requests", type=int, default=SERVER_REQUESTS,
+                        help="requests per client of the server load test")
+    args = parser.parse_args()
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        if name == "server":
+            bench_server(args.clients, args.requests)
+            continue
+        if name == "memory":
+            bench_memory(args.lengths, args.engines or SUITE_ENGINES)
+            continue
+        if name != "suite":
+            BENCHMARKS[name]()
+            continue
+        results = bench_suite(args.lengths, args.engines or SUITE_ENGINES,
+                              args.repeats)
+        _print_table("Suite", ["benchmark", "engine", "cycles", "length",
+                               "ms"],
+                     [[row["benchmark"], row["engine"], row["cycles"],
+                       row["length"], f"{row['seconds'] * 1e3:.3f}"]
+                      for row in results])
+        if args.compare:
+            compare_results(results, args.compare)
+        if args.save:
+            save_results(results, args.save)
+
+
+if __name__ == "__main__":
+    main()
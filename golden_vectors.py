@@ -0,0 +1,312 @@
+# Golden vectors and differential checks for the cipher engines.
+# Run `python golden_vectors.py record` to record golden vectors from the
+# reference engine, `python golden_vectors.py check` to check every engine
+# against the recorded vectors and `python golden_vectors.py random` to
+# check every engine against the reference engine on random inputs.
+
+import argparse
+import io
+import json
+import os
+import random
+import tempfile
+
+import SP_network_cipher as cipher
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "golden_vectors.json")
+# Lower case letters and characters which are removed are included, but \
+# not ? as it cannot be typed into a plaintext
+PLAINTEXT_CHARACTERS = [c for c in cipher.REFERENCE_LIST if c != "?"] + \
+    list("     abcxyz\n~")
+
+
+def random_codes(rng):
+    """Returns three different pass codes which pass validate_code."""
+    codes = []
+    while len(codes) < 3:
+        code = "".join(rng.choice(cipher.REFERENCE_LIST)
+                       for _ in range(rng.randint(6, 12)))
+        if code not in codes and len(set(code)) > 1:
+            codes.append(code)
+    return codes
+
+
+def random_plaintext(rng, max_length):
+    """Returns a random plaintext with at least one valid character."""
+    while True:
+        text = "".join(rng.choice(PLAINTEXT_CHARACTERS)
+                       for _ in range(rng.randint(1, max_length)))
+        if cipher._substitute(text.upper()):
+            return text
+
+
+def padding_length(plaintext):
+    """Returns the number of random letters added to the plaintext."""
+    length = len(cipher._substitute(plaintext.upper()))
+    return 0 if length % 10 == 0 else 9 - length % 10
+
+
+def random_vectors(count, seed=0, keys=10, max_length=300):
+    """
+    Returns count vectors of codes, plaintext, padding and the ciphertext
+    from the reference engine.  The vectors share the given number of
+    keys so that the batch engines are checked with several messages.
+    """
+    rng = random.Random(seed)
+    all_codes = [random_codes(rng) for _ in range(keys)]
+    vectors = []
+    for _ in range(count):
+        codes = rng.choice(all_codes)
+        plaintext = random_plaintext(rng, max_length)
+        padding = "".join(rng.choice(cipher.REFERENCE_LIST)
+                          for _ in range(padding_length(plaintext)))
+        ciphertext = cipher.encrypt(codes, plaintext, "reference",
+                                    cipher.FixedPadding(padding))
+        vectors.append({"codes": codes, "plaintext": plaintext,
+                        "padding": padding, "ciphertext": ciphertext})
+    return vectors
+
+
+def expected_plaintext(vector):
+    """Returns the decryption of the vector, including its padding."""
+    text = cipher._substitute(vector["plaintext"].upper())
+    text = cipher._add_random(text, cipher.FixedPadding(vector["padding"]))
+    return cipher._reinstate_space(text)
+
+
+def record(path=GOLDEN_PATH, count=100, seed=0):
+    """Records golden vectors from the reference engine."""
+    vectors = random_vectors(count, seed)
+    with open(path, "w") as file:
+        json.dump({"seed": seed, "vectors": vectors}, file, indent=1)
+    return vectors
+
+
+def load(path=GOLDEN_PATH):
+    """Returns the recorded golden vectors."""
+    with open(path) as file:
+        return json.load(file)["vectors"]
+
+
+def _by_key(vectors):
+    """Groups the positions of the vectors by their codes."""
+    groups = {}
+    for position, vector in enumerate(vectors):
+        groups.setdefault(tuple(vector["codes"]), []).append(position)
+    return groups
+
+
+def _check_engine(engine, vectors):
+    """Checks one of the single message engines."""
+    failures = []
+    for position, vector in enumerate(vectors):
+        ciphertext = cipher.encrypt(vector["codes"], vector["plaintext"],
+                                    engine,
+                                    cipher.FixedPadding(vector["padding"]))
+        if ciphertext != vector["ciphertext"]:
+            failures.append((engine, position, "encrypt"))
+        plaintext = cipher.decrypt(vector["codes"], vector["ciphertext"],
+                                   engine)
+        if plaintext != expected_plaintext(vector):
+            failures.append((engine, position, "decrypt"))
+    return failures
+
+
+def _check_batch(engine, vectors):
+    """Checks encrypt_many and decrypt_many with all messages of a key."""
+    name = f"batch {engine}"
+    failures = []
+    for codes, positions in _by_key(vectors).items():
+        group = [vectors[position] for position in positions]
+        padding = cipher.FixedPadding(
+            "".join(vector["padding"] for vector in group))
+        ciphertexts = cipher.encrypt_many(
+            codes, [vector["plaintext"] for vector in group], engine,
+            batch_size=7, rng=padding)
+        plaintexts = cipher.decrypt_many(
+            codes, [vector["ciphertext"] for vector in group], engine,
+            batch_size=7)
+        for position, vector, ciphertext, plaintext in zip(
+                positions, group, ciphertexts, plaintexts):
+            if ciphertext != vector["ciphertext"]:
+                failures.append((name, position, "encrypt"))
+            if plaintext != expected_plaintext(vector):
+                failures.append((name, position, "decrypt"))
+    return failures
+
+
+def _check_parallel(vectors):
+    """Checks the process pool, encrypting only the unpadded messages."""
+    failures = []
+    for codes, positions in _by_key(vectors).items():
+        group = [vectors[position] for position in positions]
+        # The random letters of each worker cannot be given, so only the \
+        # messages without random letters can be compared
+        unpadded = [(position, vector) for position, vector
+                    in zip(positions, group) if not vector["padding"]]
+        with cipher.ParallelCipher(codes, workers=2, chunk_size=3) as pool:
+            ciphertexts = pool.encrypt([vector["plaintext"]
+                                        for _, vector in unpadded])
+            plaintexts = pool.decrypt([vector["ciphertext"]
+                                       for vector in group])
+        for (position, vector), ciphertext in zip(unpadded, ciphertexts):
+            if ciphertext != vector["ciphertext"]:
+                failures.append(("parallel", position, "encrypt"))
+        for position, vector, plaintext in zip(positions, group, plaintexts):
+            if plaintext != expected_plaintext(vector):
+                failures.append(("parallel", position, "decrypt"))
+    return failures
+
+
+def _check_stream(vectors):
+    """Checks the streams, with each message as one frame."""
+    failures = []
+    for position, vector in enumerate(vectors):
+        length = len(cipher._substitute(vector["plaintext"].upper()))
+        encrypted = io.StringIO()
+        cipher.encrypt_stream(vector["codes"], io.StringIO(vector["plaintext"]),
+                              encrypted, chunk_size=(length // 10 + 1) * 10,
+                              rng=cipher.FixedPadding(vector["padding"]))
+        frame = encrypted.getvalue()
+        if frame.split("\n")[1] != vector["ciphertext"]:
+            failures.append(("stream", position, "encrypt"))
+        decrypted = io.StringIO()
+        cipher.decrypt_stream(vector["codes"], io.StringIO(frame), decrypted)
+        if decrypted.getvalue() != expected_plaintext(vector)[:length]:
+            failures.append(("stream", position, "decrypt"))
+    return failures
+
+
+def _check_into(vectors):
+    """Checks encrypt_into and decrypt_into with a buffer per message."""
+    failures = []
+    for position, vector in enumerate(vectors):
+        out = bytearray(len(vector["ciphertext"]) + 8)
+        count = cipher.encrypt_into(vector["codes"], vector["plaintext"], out,
+                                    rng=cipher.FixedPadding(vector["padding"]))
+        if out[:count].decode("ascii") != vector["ciphertext"]:
+            failures.append(("into", position, "encrypt"))
+        count = cipher.decrypt_into(vector["codes"], vector["ciphertext"], out)
+        if out[:count].decode("ascii") != expected_plaintext(vector):
+            failures.append(("into", position, "decrypt"))
+    return failures
+
+
+def _check_schedule_bytes(vectors):
+    """Checks key schedules which are saved and loaded as bytes."""
+    failures = []
+    schedules = {}
+    for position, vector in enumerate(vectors):
+        codes = tuple(vector["codes"])
+        if codes not in schedules:
+            data = cipher.KeySchedule(codes).to_bytes()
+            schedules[codes] = cipher.KeySchedule.from_bytes(data)
+        schedule = schedules[codes]
+        ciphertext = schedule.encrypt(vector["plaintext"], "plan",
+                                      cipher.FixedPadding(vector["padding"]))
+        if ciphertext != vector["ciphertext"]:
+            failures.append(("schedule bytes", position, "encrypt"))
+        if schedule.decrypt(vector["ciphertext"], "plan") != \
+                expected_plaintext(vector):
+            failures.append(("schedule bytes", position, "decrypt"))
+    return failures
+
+
+def _check_files(vectors):
+    """
+    Checks encrypt_file and decrypt_file with a file of the messages of
+    each key, one per line after an empty line, against the vectors.
+    """
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, name)
+                 for name in ("plaintext", "ciphertext", "decrypted")]
+        for codes, positions in _by_key(vectors).items():
+            group = [vectors[position] for position in positions]
+            # Line breaks are removed from the messages, as ~ is, so each \
+            # message is written as one line with ~ for its line breaks
+            with open(paths[0], "w") as file:
+                file.write("\n")
+                file.writelines(vector["plaintext"].replace("\n", "~") + "\n"
+                                for vector in group)
+            padding = cipher.FixedPadding(
+                "".join(vector["padding"] for vector in group))
+            cipher.encrypt_file(codes, paths[0], paths[1], batch_size=7,
+                                rng=padding)
+            cipher.decrypt_file(codes, paths[1], paths[2], batch_size=7)
+            with open(paths[1]) as file:
+                ciphertexts = file.read().split("\n")
+            with open(paths[2]) as file:
+                plaintexts = file.read().split("\n")
+            # The empty line is left empty by both
+            if ciphertexts[0] or plaintexts[0]:
+                failures.append(("file", None, "empty line"))
+            ciphertexts, plaintexts = ciphertexts[1:], plaintexts[1:]
+            for position, vector, ciphertext, plaintext in zip(
+                    positions, group, ciphertexts, plaintexts):
+                if ciphertext != vector["ciphertext"]:
+                    failures.append(("file", position, "encrypt"))
+                if plaintext != expected_plaintext(vector):
+                    failures.append(("file", position, "decrypt"))
+    return failures
+
+
+def check(vectors, engines=None):
+    """
+    Checks every engine, the batches, the process pool, the streams, the
+    buffers, the saved key schedules and the files against the vectors.
+    Returns a list of (engine, vector, direction) for every mismatch.
+    """
+    checks = {engine: (lambda engine=engine: _check_engine(engine, vectors))
+              for engine in cipher.ENGINES}
+    for engine in cipher.NUMBER_ENGINES:
+        checks[f"batch {engine}"] = \
+            lambda engine=engine: _check_batch(engine, vectors)
+    checks["parallel"] = lambda: _check_parallel(vectors)
+    checks["stream"] = lambda: _check_stream(vectors)
+    checks["into"] = lambda: _check_into(vectors)
+    checks["schedule bytes"] = lambda: _check_schedule_bytes(vectors)
+    checks["file"] = lambda: _check_files(vectors)
+    failures = []
+    for name, function in checks.items():
+        if engines and name not in engines:
+            continue
+        found = function()
+        print(f"{name}: {len(vectors) * 2 - len(found)} passed, "
+              f"{len(found)} failed")
+        failures += found
+    return failures
+
+
+def main():
+    """Records or checks the golden vectors."""
+    parser = argparse.ArgumentParser(
+        description="Golden vectors and differential checks for the cipher.")
+    parser.add_argument("command", choices=["record", "check", "random"])
+    parser.add_argument("--path", default=GOLDEN_PATH,
+                        help="file of golden vectors")
+    parser.add_argument("--count", type=int, default=None,
+                        help="number of vectors to record or generate")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the random vectors")
+    parser.add_argument("--engine", action="append", dest="engines",
+                        help="only check this engine, may be repeated")
+    args = parser.parse_args()
+    if args.command == "record":
+        vectors = record(args.path, args.count or 100, args.seed)
+        print(f"Recorded {len(vectors)} vectors to {args.path}")
+        return
+    if args.command == "check":
+        vectors = load(args.path)
+    else:
+        vectors = random_vectors(args.count or 1000, args.seed)
+    failures = check(vectors, args.engines)
+    for failure in failures:
+        print("Mismatch: {} vector {} {}".format(*failure))
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()